@@ -19,10 +19,13 @@
 # xx CC 0
 
 import math
-import mido
 import os
 
 import patch
+import sysex_reader
+
+# Length in bytes of a single dump sysex message, holding one patch.
+SINGLE_DUMP_LENGTH = 524
 
 categories = {0: 'off', 1: 'lead', 2: 'bass', 3: 'pad',
               4: 'decay', 5: 'pluck', 6: 'acid', 7: 'classic',
@@ -961,6 +964,10 @@ def euclidean_distance(a, b):
    return math.sqrt(reduce(lambda i,j: i + ((a[j] - b[j]) ** 2), range(dimension), 0))
 
 class AccessPatch(patch.Patch):
+    __slots__ = ()
+
+    summary_keys = ['patch_name', 'patch_category_1', 'patch_category_2']
+
     def __init__(self, filepath):
         # cc_offset counts 3 bytes for manufacturer, 4 for device, bank,
         # and patch, and two for who knows.
@@ -1111,42 +1118,41 @@ class AccessPatch(patch.Patch):
 
         return result
 
-def read_patches(filepath):
-    """Read multiple Virus TI patches from file."""
-    patches = []
-
-    if filepath.endswith('syx'):
-        # Single patch.
-        messages = mido.read_syx_file(filepath)
-        for message in messages:
-            bytes = message.bin()
-            if len(bytes) != 524:
-                # Not patch.
-                continue
-            patch_name = str(bytes[0xf9:0x103])
-            patch_name = patch_name.strip()
-            p = AccessPatch(filepath)
-            p.name = patch_name
-            p.collection = os.path.basename(filepath)
-            p.parse(message.bin())
-            patches.append(p)
-    elif filepath.endswith('mid'):
-        patch_file = mido.MidiFile(filepath)
-        for i, track in enumerate(patch_file.tracks):
-            for msg in track:
-                bytes = msg.bin()
-                if len(bytes) == 524:
-                    track_number = msg.bin()[8]
-
-                    patch_name = str(bytes[0xf9:0x103])
-                    patch_name = patch_name.strip()
-                    p = AccessPatch(filepath)
-                    p.name = patch_name
-                    p.collection = os.path.basename(filepath)
-                    p.parse(msg.bin())
-                    patches.append(p)
-
-    return patches
+def read_patches(filepath, messages=None):
+    """Read multiple Virus TI patches from file.
+
+    messages optionally holds the sysex messages already read from the
+    file, so the file isn't read again.
+    """
+    return list(iter_patches(filepath, messages))
+
+def iter_patches(filepath, messages=None):
+    """Yields Virus TI patches from a file one at a time.
+
+    messages is an optional iterable of sysex messages from the file.
+    Otherwise .syx files are read whole, and .mid files are streamed, so
+    a large bank is never held in memory apart from its patches.
+    """
+    if messages is None:
+        if filepath.endswith('syx'):
+            messages = sysex_reader.read_syx_file(filepath)
+        elif filepath.endswith('mid'):
+            messages = sysex_reader.read_midi_sysex(filepath,
+                                                    SINGLE_DUMP_LENGTH)
+        else:
+            return
+
+    for bytes in messages:
+        if len(bytes) != SINGLE_DUMP_LENGTH:
+            # Not patch.
+            continue
+        patch_name = str(bytes[0xf9:0x103])
+        patch_name = patch_name.strip()
+        p = AccessPatch(filepath)
+        p.name = patch_name
+        p.collection = os.path.basename(filepath)
+        p.parse(bytes)
+        yield p
 
 def main():
         patches = read_patches('/Users/bowdidge/Documents/Access Music/Virus TI/Patches/Classic Live Patches For Virus TI.mid')
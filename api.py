@@ -0,0 +1,80 @@
+#!/usr/bin/env python2.7
+#
+# JSON representations of patches for the /api/ pages.
+#
+# Scripts that want patch parameters shouldn't have to scrape HTML.  The
+# API returns the parsed settings of each patch directly, optionally
+# limited to the fields a client asks for.
+#
+# Robert Bowdidge, December 2019.
+
+import json
+
+# Fields describing every patch, as opposed to its parameters.
+PATCH_FIELDS = ['name', 'device', 'collection', 'locations', 'is_favorite']
+
+
+def settings_json(settings):
+    """Returns a plain dictionary copy of a patch's settings."""
+    out = {}
+    for key, value in settings.items():
+        if hasattr(value, 'items'):
+            value = settings_json(value)
+        out[key] = value
+    return out
+
+
+def patch_json(p, fields=None):
+    """Returns a dictionary describing a patch, ready for json.dumps.
+
+    fields optionally lists the keys wanted, from PATCH_FIELDS and the
+    patch's settings.  Without fields, all settings are included under
+    'settings'.
+    """
+    out = {}
+    if fields is None:
+        for field in PATCH_FIELDS:
+            out[field] = getattr(p, field)
+        out['settings'] = settings_json(p.settings)
+        return out
+
+    for field in fields:
+        if field in PATCH_FIELDS:
+            out[field] = getattr(p, field)
+        elif field in p.settings:
+            value = p.settings[field]
+            if hasattr(value, 'items'):
+                value = settings_json(value)
+            out[field] = value
+    return out
+
+
+def similar_json(p, similar_patches_and_scores, fields=None, blocks=None):
+    """Returns a dictionary describing the patches nearest p.
+
+    blocks optionally lists, for each similar patch, a dictionary mapping
+    block name to distance.
+    """
+    similar = []
+    for i, (other, score) in enumerate(similar_patches_and_scores):
+        entry = patch_json(other, fields or ['name'])
+        entry['score'] = score
+        if blocks is not None:
+            entry['blocks'] = blocks[i]
+        similar.append(entry)
+    return {'name': p.name, 'similar': similar}
+
+
+def parse_fields(query):
+    """Returns list of fields requested with fields=a,b in a query."""
+    if 'fields' not in query:
+        return None
+    fields = []
+    for value in query['fields']:
+        fields.extend(f for f in value.split(',') if f)
+    return fields
+
+
+def dumps(value):
+    """Returns compact JSON text for value."""
+    return json.dumps(value, separators=(',', ':'), sort_keys=True)
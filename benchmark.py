@@ -0,0 +1,267 @@
+#!/usr/bin/env python2.7
+#
+# Benchmarks for Patch Compare's hot paths.
+#
+# Usage: benchmark.py parse [patch.syx]
+#        benchmark.py load [--clients N] [url ...]
+#        benchmark.py similar [--size N] [patch.syx ...]
+#
+# Robert Bowdidge, December 2019.
+
+import argparse
+import numpy
+import random
+import sys
+import threading
+import time
+import timeit
+import urllib2
+
+import access_patch
+import patch
+import similarity
+import sysex_reader
+
+DEFAULT_PATCH = 'test/Nylon test.syx'
+
+DEFAULT_URLS = ['http://localhost:8080/']
+
+# Range of bytes in a Virus patch holding parameters, before the name.
+VIRUS_PARAMETERS = (9, 0xf9)
+
+
+def interpreted_parse(sysex, definitions, cc_offset, the_dict):
+    """The original Patch.parse loop, kept as the baseline to beat."""
+    for rule in definitions:
+        try:
+            block, label, offset, bytes, type = rule
+        except Exception as e:
+            print 'problems parsing %s:%s' % (rule, e)
+            continue
+        full_label = '%s_%s' % (block, label)
+
+        the_dict[full_label + '_numeric'] = sysex[cc_offset + offset]
+        if type is patch.STRING_TYPE:
+            the_dict[full_label] = str(
+                sysex[cc_offset + offset:cc_offset + offset + bytes]).strip()
+        elif type is patch.NONE_TYPE:
+            pass
+        elif type is patch.POSITIVE_TYPE:
+            the_dict[full_label] = sysex[cc_offset + offset]
+        elif type is patch.PLUS_MINUS_TYPE:
+            the_dict[full_label] = sysex[cc_offset + offset] - 64
+        elif type is patch.PLUS_MINUS_PERCENT_TYPE:
+            the_dict[full_label] = 100 * (sysex[cc_offset + offset] - 64) / 64
+        elif type is patch.PERCENT_TYPE:
+            the_dict[full_label] = (100 * sysex[cc_offset + offset] / 124)
+        else:
+            the_dict[full_label] = sysex[cc_offset + offset]
+    return the_dict
+
+
+def best_time(function, number):
+    """Returns best time in microseconds for one call of function."""
+    times = timeit.repeat(function, number=number, repeat=5)
+    return min(times) / number * 1e6
+
+
+def benchmark_parse(args):
+    """Compares the compiled parse plan with the interpreted loop."""
+    messages = [m for m in sysex_reader.read_syx_file(args.patch_file)
+                if len(m) == 524]
+    if not messages:
+        print 'No Virus patches in %s' % args.patch_file
+        return 1
+    sysex = messages[0]
+    definitions = access_patch.access_definitions
+    cc_offset = access_patch.AccessPatch(args.patch_file).cc_offset
+    plan = patch.parse_plan(definitions, cc_offset)
+
+    expected = interpreted_parse(sysex, definitions, cc_offset, {})
+    actual = {}
+    plan.parse(sysex, actual)
+    if expected != actual:
+        print 'Compiled parse differs from interpreted parse!'
+        return 1
+
+    old = best_time(
+        lambda: interpreted_parse(sysex, definitions, cc_offset, {}),
+        args.number)
+    new = best_time(lambda: plan.parse(sysex, {}), args.number)
+    print 'interpreted parse: %8.1f us per patch' % old
+    print 'compiled parse:    %8.1f us per patch' % new
+    print 'speed-up:          %8.1fx' % (old / new)
+    return 0
+
+
+def benchmark_load(args):
+    """Measures throughput of a running server with concurrent clients.
+
+    Start patch_compare.py with different --threads values and compare
+    the requests per second.
+    """
+    urls = args.urls or DEFAULT_URLS
+    errors = []
+    latencies = []
+    lock = threading.Lock()
+
+    def client(client_number):
+        for i in range(args.requests):
+            url = urls[(client_number + i) % len(urls)]
+            start = time.time()
+            try:
+                urllib2.urlopen(url).read()
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                continue
+            with lock:
+                latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=client, args=(i,))
+               for i in range(args.clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    print '%d clients, %d requests, %d errors in %.2fs' % (
+        args.clients, len(latencies), len(errors), elapsed)
+    if latencies:
+        print 'throughput:     %8.1f requests/s' % (len(latencies) / elapsed)
+        print 'median latency: %8.1f ms' % (
+            latencies[len(latencies) / 2] * 1000)
+        print '95th latency:   %8.1f ms' % (
+            latencies[int(len(latencies) * 0.95)] * 1000)
+    return 0
+
+
+def synthesize_patches(messages, size, seed=0):
+    """Returns size Virus patches made by mutating sysex messages.
+
+    Each new patch copies an earlier one and changes a few parameters, so
+    the library has families of related sounds, like real collections.
+    """
+    generator = random.Random(seed)
+    sysexes = [bytearray(m) for m in messages]
+    patches = []
+    for i in range(size):
+        sysex = bytearray(generator.choice(sysexes))
+        for _ in range(generator.randint(1, 24)):
+            sysex[generator.randrange(*VIRUS_PARAMETERS)] = (
+                generator.randrange(128))
+        sysex[0xf9:0x103] = bytearray(('S%07d' % i).ljust(10))
+        sysexes.append(sysex)
+        p = access_patch.AccessPatch('synthetic')
+        p.name = str(sysex[0xf9:0x103]).strip()
+        p.collection = 'synthetic'
+        p.parse(sysex)
+        patches.append(p)
+    return patches
+
+
+def benchmark_similar(args):
+    """Compares approximate similarity search with the exact ranking.
+
+    The exact ranking is SimilarityEngine's, which matches sorting by
+    AccessPatch.compare; --check-compare confirms that for one query.
+    """
+    messages = []
+    for filepath in args.patch_files or [DEFAULT_PATCH]:
+        messages.extend(m for m in sysex_reader.read_syx_file(filepath)
+                        if len(m) == 524)
+    if not messages:
+        print 'No Virus patches found'
+        return 1
+    start = time.time()
+    patches = synthesize_patches(messages, args.size)
+    print '%d patches synthesized in %.1fs' % (len(patches),
+                                               time.time() - start)
+    engine = similarity.SimilarityEngine(access_patch.access_definitions,
+                                         patches)
+    queries = random.Random(1).sample(patches, min(args.queries,
+                                                   len(patches)))
+
+    if args.check_compare:
+        query = queries[0]
+        by_compare = sorted((p for p in patches if p is not query),
+                            key=lambda p: query.compare(p))[:args.count]
+        by_engine = [p for p, _ in engine.most_similar(query, args.count)]
+        print 'engine ranking matches compare: %s' % (
+            [p.name for p in by_compare] == [p.name for p in by_engine])
+
+    start = time.time()
+    exact = [set(p for p, _ in engine.most_similar(q, args.count))
+             for q in queries]
+    exact_time = (time.time() - start) / len(queries)
+    print 'exact search:          %8.2f ms per query' % (exact_time * 1000)
+
+    start = time.time()
+    index = similarity.LSHIndex(engine, args.tables)
+    index.buckets()
+    print 'LSH index built in %.2fs, slot width %.1f' % (
+        time.time() - start, index.width)
+
+    probes = 1
+    while probes <= args.tables:
+        start = time.time()
+        found = [index.most_similar(q, args.count, probes) for q in queries]
+        elapsed = (time.time() - start) / len(queries)
+        recall = numpy.mean([len(expected & set(p for p, _ in result)) /
+                             float(len(expected))
+                             for expected, result in zip(exact, found)])
+        candidates = numpy.mean([len(index.candidates(q, probes))
+                                 for q in queries])
+        print ('%2d tables: %8.2f ms per query, %5.1fx faster, recall %.3f, '
+               '%d candidates' % (probes, elapsed * 1000, exact_time / elapsed,
+                                  recall, candidates))
+        probes *= 2
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for Patch Compare.')
+    subparsers = parser.add_subparsers()
+
+    parse_parser = subparsers.add_parser(
+        'parse', help='time parsing a 524 byte Virus patch')
+    parse_parser.add_argument('patch_file', nargs='?', default=DEFAULT_PATCH)
+    parse_parser.add_argument('--number', type=int, default=2000)
+    parse_parser.set_defaults(function=benchmark_parse)
+
+    load_parser = subparsers.add_parser(
+        'load', help='load test a running patch_compare.py server')
+    load_parser.add_argument('urls', nargs='*', metavar='url',
+                             help='pages to fetch (default: %s)' %
+                             DEFAULT_URLS[0])
+    load_parser.add_argument('--clients', type=int, default=8)
+    load_parser.add_argument('--requests', type=int, default=50,
+                             help='requests made by each client')
+    load_parser.set_defaults(function=benchmark_load)
+
+    similar_parser = subparsers.add_parser(
+        'similar', help='compare approximate and exact similarity search')
+    similar_parser.add_argument('patch_files', nargs='*', metavar='patch_file',
+                                help='Virus patches to build the library '
+                                'from (default: %s)' % DEFAULT_PATCH)
+    similar_parser.add_argument('--size', type=int, default=50000,
+                                help='number of patches in the library')
+    similar_parser.add_argument('--queries', type=int, default=50)
+    similar_parser.add_argument('--count', type=int, default=10,
+                                help='similar patches found per query')
+    similar_parser.add_argument('--tables', type=int,
+                                default=similarity.DEFAULT_LSH_TABLES)
+    similar_parser.add_argument('--check-compare', action='store_true',
+                                help='check the exact ranking against '
+                                'AccessPatch.compare (slow)')
+    similar_parser.set_defaults(function=benchmark_similar)
+
+    args = parser.parse_args()
+    return args.function(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
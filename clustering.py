@@ -0,0 +1,203 @@
+#!/usr/bin/env python2.7
+#
+# Grouping a whole library into clusters of similar patches.
+#
+# The distance between every pair of patches of a device is computed in
+# square tiles, using the same encoding as SimilarityEngine, and written to
+# a memory-mapped file so libraries larger than memory can be clustered.
+# k-medoids clustering then picks representative patches and groups every
+# other patch with its nearest representative.  Groups are saved as JSON
+# for the web server to show; see group_patches.py.
+#
+# Robert Bowdidge, December 2019.
+
+import json
+import multiprocessing
+import multiprocessing.pool
+import numpy
+
+import similarity
+
+# Name of the file holding groups, in the cache directory by default.
+GROUPS_FILENAME = 'groups.json'
+
+# Rows and columns in each tile of the distance matrix.
+DEFAULT_BLOCK_SIZE = 1024
+
+# Average number of patches in each group, unless told otherwise.
+DEFAULT_GROUP_SIZE = 25
+
+# Most rounds of k-medoids refinement.
+MAX_ITERATIONS = 20
+
+
+def distance_matrix(engine, filename, block_size=DEFAULT_BLOCK_SIZE,
+                    workers=None):
+    """Writes distances between all patches in engine to a memory map.
+
+    Returns the numpy.memmap, a float32 matrix with a row and column for
+    each engine row.  Distances match SimilarityEngine.distances.  Each
+    tile is computed with whole-array operations (a matrix product for
+    numeric parameters, using |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, and a
+    comparison per SELECT_TYPE parameter), and tiles are spread over a
+    pool of threads; numpy releases the interpreter lock for the work.
+    """
+    count = len(engine.patches)
+    distances = numpy.memmap(filename, dtype=numpy.float32, mode='w+',
+                             shape=(count, count))
+    if not count:
+        return distances
+    numeric = engine.numeric.astype(numpy.float64)
+    norms = numpy.einsum('ij,ij->i', numeric, numeric)
+    select = engine.select
+    penalty = float(similarity.SELECT_MISMATCH_PENALTY ** 2)
+
+    def compute_tile(tile):
+        row_start, column_start = tile
+        rows = slice(row_start, min(row_start + block_size, count))
+        columns = slice(column_start, min(column_start + block_size, count))
+        squares = (norms[rows, numpy.newaxis] + norms[numpy.newaxis, columns]
+                   - 2 * numeric[rows].dot(numeric[columns].T))
+        mismatches = numpy.zeros(squares.shape, dtype=numpy.int32)
+        for column in range(select.shape[1]):
+            mismatches += (select[rows, column, numpy.newaxis] !=
+                           select[numpy.newaxis, columns, column])
+        squares += mismatches * penalty
+        tile_distances = numpy.sqrt(numpy.maximum(squares, 0)).astype(
+            numpy.float32)
+        distances[rows, columns] = tile_distances
+        distances[columns, rows] = tile_distances.T
+
+    # Only tiles on or above the diagonal; each fills its mirror image.
+    tiles = [(row_start, column_start)
+             for row_start in range(0, count, block_size)
+             for column_start in range(row_start, count, block_size)]
+    pool = multiprocessing.pool.ThreadPool(
+        workers or multiprocessing.cpu_count())
+    try:
+        pool.map(compute_tile, tiles)
+    finally:
+        pool.close()
+        pool.join()
+    distances.flush()
+    return distances
+
+
+def assign(distances, medoids, block_size=DEFAULT_BLOCK_SIZE):
+    """Returns (nearest medoid index, distance to it) for every row.
+
+    Distances are read in tiles of block_size medoids by block_size
+    columns, keeping the nearest medoid found so far for each column, so
+    memory use doesn't grow with the size of the library.
+    """
+    count = len(distances)
+    labels = numpy.zeros(count, dtype=int)
+    nearest = numpy.full(count, numpy.inf, dtype=numpy.float32)
+    for column_start in range(0, count, block_size):
+        columns = slice(column_start, min(column_start + block_size, count))
+        for medoid_start in range(0, len(medoids), block_size):
+            rows = medoids[medoid_start:medoid_start + block_size]
+            tile = numpy.asarray(distances[rows, columns])
+            tile_labels = numpy.argmin(tile, axis=0)
+            tile_nearest = tile[tile_labels, numpy.arange(tile.shape[1])]
+            # Ties go to the earlier medoid, as with a single argmin.
+            closer = tile_nearest < nearest[columns]
+            labels[columns][closer] = tile_labels[closer] + medoid_start
+            nearest[columns][closer] = tile_nearest[closer]
+    return labels, nearest
+
+
+def total_distances(distances, members, block_size=DEFAULT_BLOCK_SIZE):
+    """Returns the sum of distances from each member to all the others.
+
+    Only the members x members part of the matrix is read, block_size
+    rows at a time.
+    """
+    totals = numpy.zeros(len(members), dtype=numpy.float64)
+    for start in range(0, len(members), block_size):
+        rows = members[start:start + block_size]
+        totals[start:start + len(rows)] = numpy.asarray(
+            distances[numpy.ix_(rows, members)]).sum(axis=1)
+    return totals
+
+
+def k_medoids(distances, count, iterations=MAX_ITERATIONS, seed=0,
+              block_size=DEFAULT_BLOCK_SIZE):
+    """Clusters rows of a distance matrix around count medoids.
+
+    Starts from k-medoids++ choices (each medoid picked with probability
+    growing with its distance from the ones already picked), then
+    alternates assigning rows to their nearest medoid and moving each
+    medoid to the member closest to the rest of its cluster.  Returns
+    (list of medoid rows, array of medoid index for each row).  The
+    distances are read block_size rows or columns at a time.
+    """
+    size = len(distances)
+    count = max(1, min(count, size))
+    random = numpy.random.RandomState(seed)
+    medoids = [random.randint(size)]
+    nearest = numpy.array(distances[medoids[0]], dtype=numpy.float64)
+    while len(medoids) < count:
+        weights = nearest ** 2
+        total = weights.sum()
+        if not total:
+            # Every remaining patch is identical to a medoid.
+            break
+        choice = random.choice(size, p=weights / total)
+        medoids.append(choice)
+        nearest = numpy.minimum(nearest, distances[choice])
+
+    for _ in range(iterations):
+        labels, _ = assign(distances, medoids, block_size)
+        new_medoids = []
+        for index, medoid in enumerate(medoids):
+            members = numpy.flatnonzero(labels == index)
+            if not len(members):
+                new_medoids.append(medoid)
+                continue
+            totals = total_distances(distances, members, block_size)
+            new_medoids.append(int(members[numpy.argmin(totals)]))
+        if new_medoids == medoids:
+            break
+        medoids = new_medoids
+    labels, _ = assign(distances, medoids, block_size)
+    return medoids, labels
+
+
+def make_groups(engine, distances, medoids, labels, content_hashes,
+                block_size=DEFAULT_BLOCK_SIZE):
+    """Returns list of groups for JSON, largest first.
+
+    Each group is a dictionary holding the medoid's name and content
+    hash, and a list of [name, content hash, distance to medoid] for
+    every member, nearest first.
+    """
+    _, to_medoid = assign(distances, medoids, block_size)
+    groups = []
+    for index, medoid in enumerate(medoids):
+        members = numpy.flatnonzero(labels == index)
+        if not len(members):
+            continue
+        members = members[numpy.argsort(to_medoid[members],
+                                        kind='mergesort')]
+        groups.append({
+            'medoid': engine.patches[medoid].name,
+            'medoid_hash': content_hashes[engine.patches[medoid]],
+            'members': [[engine.patches[row].name,
+                         content_hashes[engine.patches[row]],
+                         round(float(to_medoid[row]), 2)]
+                        for row in members]})
+    groups.sort(key=lambda group: (-len(group['members']), group['medoid']))
+    return groups
+
+
+def write_groups(filename, groups):
+    """Saves dictionary mapping device name to list of groups."""
+    with open(filename, 'w') as f:
+        json.dump(groups, f, sort_keys=True, separators=(',', ':'))
+
+
+def read_groups(filename):
+    """Returns dictionary mapping device name to list of groups."""
+    with open(filename) as f:
+        return json.load(f)
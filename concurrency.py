@@ -0,0 +1,99 @@
+#!/usr/bin/env python2.7
+#
+# Threading support for serving several clients at once.
+#
+# Robert Bowdidge, December 2019.
+
+import BaseHTTPServer
+import contextlib
+import Queue
+import threading
+
+
+class ThreadPoolHTTPServer(BaseHTTPServer.HTTPServer):
+    """HTTP server handling requests on a fixed pool of worker threads.
+
+    SocketServer.ThreadingMixIn starts a new thread for every request;
+    a fixed pool keeps the number of threads bounded under load.
+    """
+
+    # Connections waiting to be accepted.
+    request_queue_size = 64
+
+    def __init__(self, server_address, handler_class, workers=8):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address,
+                                           handler_class)
+        # Accepted requests waiting for a worker.
+        self.requests = Queue.Queue()
+        for i in range(workers):
+            thread = threading.Thread(target=self.process_requests,
+                                      name='http-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        """Hands an accepted request to the worker threads."""
+        self.requests.put((request, client_address))
+
+    def process_requests(self):
+        """Main loop for worker threads."""
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+class ReadWriteLock(object):
+    """Lock allowing any number of readers, or a single writer.
+
+    Request handlers read the patch library in parallel; changes to the
+    library wait for them to finish.  Writers go first: once one is
+    waiting, new readers wait too, so steady traffic can't hold off a
+    change forever.  Readers mustn't take the lock again while holding it.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        # Number of threads holding the lock for reading.
+        self.readers = 0
+        # True if a thread holds the lock for writing.
+        self.writer = False
+        # Number of threads waiting to hold the lock for writing.
+        self.waiting_writers = 0
+
+    @contextlib.contextmanager
+    def reading(self):
+        """Context manager holding the lock for reading."""
+        with self.condition:
+            while self.writer or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self):
+        """Context manager holding the lock for writing."""
+        with self.condition:
+            self.waiting_writers += 1
+            try:
+                while self.writer or self.readers:
+                    self.condition.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python2.7
+#
+# Finding patch files in directory trees.
+#
+# Patch collections nest folders arbitrarily deep.  find_files walks each
+# tree once, yielding files as soon as they're found so decoding can start
+# before the walk is over.  A few bytes of each file are read to skip
+# files that can't be patches, whatever their name.
+#
+# Robert Bowdidge, December 2019.
+
+import fnmatch
+import logging
+import os
+
+# scandir reports which entries are directories without a stat per entry.
+# It's in os from Python 3.5, and available as a package for Python 2.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# File name patterns of patch files.
+DEFAULT_INCLUDE = ['*.syx', '*.mid']
+
+# Number of bytes read from the start of each file for sniffing.
+SNIFF_SIZE = 16
+
+logger = logging.getLogger(__name__)
+
+
+def list_directory(directory):
+    """Returns sorted list of (name, path, is_directory) for a directory."""
+    if scandir is not None:
+        entries = [(entry.name, entry.path, entry.is_dir())
+                   for entry in scandir(directory)]
+    else:
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            entries.append((name, path, os.path.isdir(path)))
+    entries.sort()
+    return entries
+
+
+def matches_any(name, patterns):
+    """Returns True if name matches any of the fnmatch patterns."""
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def read_head(filepath):
+    """Returns the first SNIFF_SIZE bytes of a file."""
+    with open(filepath, 'rb') as f:
+        return f.read(SNIFF_SIZE)
+
+
+def find_files(roots, include=None, exclude=None, sniff=None):
+    """Yields paths of files under the root directories.
+
+    include lists file name patterns to yield, DEFAULT_INCLUDE if None.
+    exclude lists patterns for file or directory names to skip.  sniff is
+    an optional function given the first SNIFF_SIZE bytes of a file, and
+    returning False for files that should be skipped.  Each directory is
+    visited once, even if symbolic links lead to it several times.
+    """
+    if include is None:
+        include = DEFAULT_INCLUDE
+    exclude = exclude or []
+    visited = set()
+    pending = list(reversed(roots))
+    while pending:
+        directory = pending.pop()
+        real_path = os.path.realpath(directory)
+        if real_path in visited:
+            continue
+        visited.add(real_path)
+        try:
+            entries = list_directory(directory)
+        except OSError as e:
+            logger.warning('Unable to read %s: %s', directory, e)
+            continue
+
+        subdirectories = []
+        for name, path, is_directory in entries:
+            if matches_any(name, exclude):
+                continue
+            if is_directory:
+                subdirectories.append(path)
+                continue
+            if not matches_any(name, include):
+                continue
+            if sniff:
+                try:
+                    if not sniff(read_head(path)):
+                        continue
+                except IOError as e:
+                    logger.warning('Unable to read %s: %s', path, e)
+                    continue
+            yield path
+        # Files in a directory come before those in its subdirectories.
+        pending.extend(reversed(subdirectories))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python2.7
+#
+# Batch command grouping a patch library into clusters of similar patches.
+#
+# Usage: group_patches.py [options] [directory with patches] ...
+#
+# Loads the library as patch_compare.py does, computes the distance
+# between every pair of patches of each device, clusters them, and saves
+# the groups where patch_compare.py will find them.
+#
+# Robert Bowdidge, December 2019.
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+import clustering
+import discovery
+import patch_cache
+import patch_compare
+import patch_store
+import similarity
+
+logger = logging.getLogger('group_patches')
+
+
+def parse_arguments(argv):
+    """Returns parsed command line options."""
+    parser = argparse.ArgumentParser(
+        description='Groups a patch library into clusters of similar '
+        'patches.')
+    parser.add_argument('patch_dirs', nargs='+', metavar='directory',
+                        help='directory with patches')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of processes decoding patch files')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory for the decoded patch cache, '
+                        'distance matrices and groups (default: %s)' %
+                        patch_cache.default_cache_dir())
+    parser.add_argument('--no-cache', action='store_true',
+                        help='decode every patch file, ignoring the cache')
+    parser.add_argument('--include', action='append', metavar='PATTERN',
+                        help='only load files whose names match PATTERN '
+                        '(default: %s)' % ' '.join(discovery.DEFAULT_INCLUDE))
+    parser.add_argument('--exclude', action='append', metavar='PATTERN',
+                        default=[],
+                        help='skip files and directories whose names '
+                        'match PATTERN')
+    parser.add_argument('--group-size', type=int,
+                        default=clustering.DEFAULT_GROUP_SIZE,
+                        help='average number of patches in each group')
+    parser.add_argument('--block-size', type=int,
+                        default=clustering.DEFAULT_BLOCK_SIZE,
+                        help='rows and columns of the distance matrix '
+                        'computed at once')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='threads computing the distance matrix '
+                        '(default: one per CPU)')
+    parser.add_argument('--output', default=None,
+                        help='file for the groups (default: %s in the '
+                        'cache directory)' % clustering.GROUPS_FILENAME)
+    parser.add_argument('--log-level', default='info',
+                        choices=patch_compare.LOG_LEVELS,
+                        help='least important messages to log')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_arguments(sys.argv[1:])
+    patch_compare.configure_logging(args.log_level)
+    cache_dir = args.cache_dir or patch_cache.default_cache_dir()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    cache = None
+    if not args.no_cache:
+        cache = patch_cache.PatchCache(cache_dir)
+
+    files = patch_compare.find_patch_files(args.patch_dirs, args.include,
+                                           args.exclude)
+    for _, patches in patch_compare.load_files(files, cache, args.jobs):
+        patch_compare.add_patches(patches)
+    if cache:
+        cache.commit()
+    unique = sorted(patch_compare.unique_patches.items(),
+                    key=lambda (content_hash, p): (p.name, content_hash))
+    if not unique:
+        logger.error('No patches found in %s', args.patch_dirs)
+        return 1
+    content_hashes = dict((p, content_hash) for content_hash, p in unique)
+
+    stores = patch_store.build_stores(p for _, p in unique)
+    engines = similarity.build_engines(stores)
+    groups = {}
+    for device, engine in sorted(engines.items()):
+        start = time.time()
+        filename = os.path.join(cache_dir, 'distances-%s.f32' % device)
+        distances = clustering.distance_matrix(engine, filename,
+                                               args.block_size, args.workers)
+        logger.info('%s: %d x %d distances in %.1fs', device, len(distances),
+                    len(distances), time.time() - start)
+
+        start = time.time()
+        medoids, labels = clustering.k_medoids(
+            distances, len(engine.patches) // max(1, args.group_size),
+            block_size=args.block_size)
+        groups[device] = clustering.make_groups(engine, distances, medoids,
+                                                labels, content_hashes,
+                                                args.block_size)
+        logger.info('%s: %d groups in %.1fs', device, len(groups[device]),
+                    time.time() - start)
+
+    output = args.output or os.path.join(cache_dir,
+                                         clustering.GROUPS_FILENAME)
+    clustering.write_groups(output, groups)
+    logger.info('Groups written to %s', output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
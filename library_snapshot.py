@@ -0,0 +1,590 @@
+#!/usr/bin/env python2.7
+#
+# Memory-mapped snapshot of a whole patch library.
+#
+# Even with the patch cache, launching means building an object for every
+# patch.  A snapshot instead holds the library in one binary file: a fixed
+# width record for every unique patch, tables of its sysex messages and
+# locations, a string table for names, paths and sysex bytes, and for
+# every device the PatchStore's raw bytes and SimilarityEngine's matrices.
+# The server maps the file into memory, and only builds a patch object
+# when a request first touches that patch, so startup takes the same time
+# however big the library is.
+#
+# File layout: SNAPSHOT_MAGIC, the length of the header as a 4 byte
+# little-endian integer, the header as JSON, then the sections the header
+# lists, each aligned to SECTION_ALIGNMENT bytes.
+#
+# Robert Bowdidge, December 2019.
+
+import bisect
+import collections
+import json
+import mmap
+import numpy
+import os
+import struct
+import threading
+
+import patch
+import patch_cache
+import patch_store
+
+SNAPSHOT_MAGIC = 'PCSNAP\r\n'
+
+# Version of the file layout.  Bump when sections or records change.
+SNAPSHOT_VERSION = 1
+
+# Sections start at multiples of this many bytes, so numbers in them can
+# be read in place.
+SECTION_ALIGNMENT = 8
+
+# One record for each unique patch.  Strings are a start and length in the
+# string table; messages and locations are the first and count of entries
+# in their tables.  Fields are all scalars, so a record's item() is a
+# tuple of Python values.
+RECORD_DTYPE = numpy.dtype([
+    ('name_start', '<u4'), ('name_length', '<u4'),
+    ('collection_start', '<u4'), ('collection_length', '<u4'),
+    ('filepath_start', '<u4'), ('filepath_length', '<u4'),
+    ('first_message', '<u4'), ('message_count', '<u4'),
+    ('first_location', '<u4'), ('location_count', '<u4'),
+    ('device', '<u2'),
+    ('is_favorite', 'u1'),
+    ('content_hash', 'S40'),
+])
+
+# One record for each sysex message of a patch.  A group key of length 0
+# is None.
+MESSAGE_DTYPE = numpy.dtype([
+    ('group_key_start', '<u4'), ('group_key_length', '<u4'),
+    ('sysex_start', '<u4'), ('sysex_length', '<u4'),
+])
+
+# One record for each copy of a patch, as in Patch.locations.
+LOCATION_DTYPE = numpy.dtype([
+    ('collection_start', '<u4'), ('collection_length', '<u4'),
+    ('filepath_start', '<u4'), ('filepath_length', '<u4'),
+])
+
+
+class SnapshotError(Exception):
+    """Raised for files that aren't snapshots this version can read."""
+
+
+class StringTable(object):
+    """Collects strings for a snapshot, storing each distinct one once."""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        # Map from string to (start, length).
+        self.known = {}
+
+    def add(self, value):
+        """Returns (start, length) of value in the table."""
+        value = bytes(value)
+        location = self.known.get(value)
+        if location is None:
+            location = (self.size, len(value))
+            self.chunks.append(value)
+            self.size += len(value)
+            self.known[value] = location
+        return location
+
+    def contents(self):
+        return ''.join(self.chunks)
+
+
+def write_snapshot(filename, unique_patches, all_patches, stores, engines):
+    """Saves the library to filename.
+
+    unique_patches maps content hash to patch, and all_patches maps name
+    to patch, as in patch_compare.  stores and engines map device name to
+    the PatchStore and SimilarityEngine for the device.  Rows of the
+    stores keep their order.  The file is written under another name and
+    renamed, so a server reading the old snapshot is undisturbed.
+    """
+    strings = StringTable()
+    hashes = dict((p, content_hash)
+                  for content_hash, p in unique_patches.items())
+    devices = sorted(set(p.device for p in unique_patches.values()))
+
+    # Records go device by device, store rows first in row order.
+    ordered = []
+    device_info = []
+    for device_number, device in enumerate(devices):
+        store = stores.get(device)
+        store_patches = list(store.patches) if store else []
+        in_store = set(store_patches)
+        others = sorted((p for p in unique_patches.values()
+                         if p.device == device and p not in in_store),
+                        key=lambda p: hashes[p])
+        device_info.append({'name': device, 'first': len(ordered),
+                            'rows': len(store_patches),
+                            'count': len(store_patches) + len(others)})
+        ordered.extend((device_number, p) for p in store_patches + others)
+
+    records = []
+    messages = []
+    locations = []
+    for device_number, p in ordered:
+        records.append(strings.add(p.name) + strings.add(p.collection) +
+                       strings.add(p.filepath) +
+                       (len(messages), len(p.messages),
+                        len(locations), len(p.locations),
+                        device_number, p.is_favorite, hashes[p]))
+        for group_key, sysex in p.messages:
+            messages.append(strings.add(group_key or '') +
+                            strings.add(bytes(sysex)))
+        for collection, filepath in p.locations:
+            locations.append(strings.add(collection) +
+                             strings.add(filepath))
+    records = numpy.array(records, dtype=RECORD_DTYPE).reshape(-1)
+
+    positions = dict((p, index) for index, (_, p) in enumerate(ordered))
+    named = sorted((name, positions[p]) for name, p in all_patches.items()
+                   if p in positions)
+    hash_order = numpy.argsort(records['content_hash'], kind='mergesort')
+
+    sections = collections.OrderedDict()
+    sections['records'] = records
+    sections['messages'] = numpy.array(messages,
+                                       dtype=MESSAGE_DTYPE).reshape(-1)
+    sections['locations'] = numpy.array(locations,
+                                        dtype=LOCATION_DTYPE).reshape(-1)
+    sections['name_index'] = numpy.array([index for _, index in named],
+                                         dtype='<u4')
+    sections['hashes'] = records['content_hash'][hash_order]
+    sections['hash_index'] = hash_order.astype('<u4')
+    for info in device_info:
+        store = stores.get(info['name'])
+        engine = engines.get(info['name'])
+        if not store or not engine:
+            continue
+        prefix = info['name'] + '.'
+        sections[prefix + 'raw'] = store.raw[:len(store)]
+        info['numeric_labels'] = engine.numeric_labels
+        info['select_labels'] = engine.select_labels
+        sections[prefix + 'numeric'] = store.matrix(engine.numeric_labels)
+        sections[prefix + 'select'] = store.matrix(engine.select_labels)
+        collection_rows = []
+        info['collections'] = []
+        for collection, rows in sorted(store.collection_rows.items()):
+            info['collections'].append(
+                list(strings.add(collection)) +
+                [len(collection_rows), len(rows)])
+            collection_rows.extend(sorted(rows))
+        sections[prefix + 'collection_rows'] = numpy.array(
+            collection_rows, dtype='<i4')
+    sections['strings'] = numpy.frombuffer(strings.contents() or '\0',
+                                           dtype=numpy.uint8)
+
+    header = {'version': SNAPSHOT_VERSION,
+              'parser_version': patch.PARSER_VERSION,
+              'copies': len(locations),
+              'devices': device_info,
+              'sections': {}}
+    # Section offsets are relative to the end of the header, so they don't
+    # depend on the header's own length.
+    offset = 0
+    for name, array in sections.items():
+        offset = align(offset)
+        descr = array.dtype.str
+        if array.dtype.names:
+            descr = array.dtype.descr
+        header['sections'][name] = [offset, descr, list(array.shape)]
+        offset += array.nbytes
+    header_text = json.dumps(header, sort_keys=True)
+
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('<I', len(header_text)))
+        f.write(header_text)
+        start = align(f.tell())
+        for name, array in sections.items():
+            f.seek(start + header['sections'][name][0])
+            f.write(numpy.ascontiguousarray(array).tostring())
+    os.rename(temporary, filename)
+
+
+def align(offset):
+    """Returns offset rounded up to a multiple of SECTION_ALIGNMENT."""
+    return -(-offset // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+
+
+def section_dtype(descr):
+    """Returns the numpy dtype for a dtype description read from JSON."""
+    if isinstance(descr, basestring):
+        return numpy.dtype(str(descr))
+    fields = []
+    for field in descr:
+        field = [str(field[0]), str(field[1])] + [tuple(f) for f in field[2:]]
+        fields.append(tuple(field))
+    return numpy.dtype(fields)
+
+
+class Snapshot(object):
+    """A library snapshot mapped into memory.
+
+    Patches are built from their records the first time they're asked
+    for, and the same object is returned afterwards.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        # Private copy-on-write mapping: stores can change their rows in
+        # place without touching the file.  Sections are plain arrays over
+        # the mapping; numpy.memmap is much slower to slice.
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if self.data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise SnapshotError('%s is not a library snapshot' % filename)
+        start = len(SNAPSHOT_MAGIC)
+        header_length, = struct.unpack('<I', self.data[start:start + 4])
+        start += 4
+        self.header = json.loads(self.data[start:start + header_length])
+        if self.header['version'] != SNAPSHOT_VERSION:
+            raise SnapshotError('%s has snapshot version %d, expected %d' % (
+                filename, self.header['version'], SNAPSHOT_VERSION))
+        if self.header['parser_version'] != patch.PARSER_VERSION:
+            raise SnapshotError(
+                '%s was written by an older parser; save it again' %
+                filename)
+        self.sections_start = align(start + header_length)
+
+        self.devices = self.header['devices']
+        self.records = self.section('records')
+        self.messages = self.section('messages')
+        self.locations = self.section('locations')
+        self.strings_start = (self.sections_start +
+                              self.header['sections']['strings'][0])
+
+        # Map from record index to patch, and patch to record index, for
+        # patches built so far.
+        self.loaded = {}
+        self.indexes = {}
+        # Request threads may ask for the same patch at once.
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def copies(self):
+        """Returns the number of copies of patches in the library."""
+        return self.header['copies']
+
+    def section(self, name):
+        """Returns a section of the file as a numpy array, in place."""
+        offset, descr, shape = self.header['sections'][name]
+        dtype = section_dtype(descr)
+        count = int(numpy.prod(shape))
+        return numpy.frombuffer(self.data, dtype, count,
+                                self.sections_start + offset).reshape(shape)
+
+    def string(self, start, length):
+        """Returns the string at start in the string table."""
+        start += self.strings_start
+        return self.data[start:start + length]
+
+    def patch(self, index):
+        """Returns the patch for a record, building it the first time."""
+        p = self.loaded.get(index)
+        if p is not None:
+            return p
+        with self.lock:
+            p = self.loaded.get(index)
+            if p is None:
+                p = self.build_patch(index)
+                self.indexes[p] = index
+                self.loaded[index] = p
+        return p
+
+    def build_patch(self, index):
+        """Returns a new patch object for a record."""
+        (name_start, name_length, collection_start, collection_length,
+         filepath_start, filepath_length, first_message, message_count,
+         first_location, location_count, device, is_favorite,
+         _) = self.records[index].item()
+        device = str(self.devices[device]['name'])
+        p = patch_cache.PATCH_CLASSES[device](
+            self.string(filepath_start, filepath_length))
+        p.name = self.string(name_start, name_length)
+        p.collection = self.string(collection_start, collection_length)
+        p.is_favorite = bool(is_favorite)
+        messages = self.messages[first_message:first_message + message_count]
+        for (group_key_start, group_key_length,
+             sysex_start, sysex_length) in messages.tolist():
+            group_key = self.string(group_key_start, group_key_length) or None
+            p.parse(bytearray(self.string(sysex_start, sysex_length)),
+                    p.group_definitions(group_key), group_key)
+        locations = self.locations[first_location:
+                                   first_location + location_count]
+        p.locations = [(self.string(collection_start, collection_length),
+                        self.string(filepath_start, filepath_length))
+                       for (collection_start, collection_length,
+                            filepath_start, filepath_length)
+                       in locations.tolist()]
+        return p
+
+    def named_patches(self):
+        """Returns mapping from name to patch, like all_patches."""
+        order = self.section('name_index')
+        return LazyIndex(NameColumn(self, order), order, self.patch)
+
+    def unique_patches(self):
+        """Returns mapping from content hash to patch, like unique_patches."""
+        return LazyIndex(self.section('hashes'), self.section('hash_index'),
+                         self.patch)
+
+    def file_patches(self):
+        """Returns dictionary mapping each file to its patches' hashes."""
+        result = {}
+        filepaths = self.locations[['filepath_start', 'filepath_length']]
+        for first, count, content_hash in self.records[
+                ['first_location', 'location_count',
+                 'content_hash']].tolist():
+            for start, length in filepaths[first:first + count].tolist():
+                result.setdefault(self.string(start, length),
+                                  []).append(content_hash)
+        return result
+
+    def stores(self):
+        """Returns dictionary mapping device name to a PatchStore.
+
+        Stores use the snapshot's rows in place, and build patches as they
+        are asked for.  Each store keeps the matrices saved for its
+        device's SimilarityEngine, so build_engines uses them as they are.
+        """
+        stores = {}
+        for info in self.devices:
+            if 'numeric_labels' not in info:
+                continue
+            prefix = info['name'] + '.'
+            example = patch_cache.PATCH_CLASSES[info['name']]('')
+            store = patch_store.PatchStore(example.definitions,
+                                           example.cc_offset,
+                                           example.select_styles)
+            store.patches = PatchList(self, info['first'], info['rows'])
+            store.rows = SnapshotRows(self, info['first'], info['rows'])
+            store.raw = self.section(prefix + 'raw')
+            collection_rows = self.section(prefix + 'collection_rows')
+            store.collection_rows = dict(
+                (self.string(start, length),
+                 collection_rows[first:first + count].tolist())
+                for start, length, first, count in info['collections'])
+            store.matrices[tuple(info['numeric_labels'])] = self.section(
+                prefix + 'numeric')
+            store.matrices[tuple(info['select_labels'])] = self.section(
+                prefix + 'select')
+            stores[str(info['name'])] = store
+        return stores
+
+
+class NameColumn(collections.Sequence):
+    """Sequence of the names of records, in the given order."""
+
+    def __init__(self, snapshot, order):
+        self.snapshot = snapshot
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, i):
+        record = self.snapshot.records[self.order[i]].item()
+        return self.snapshot.string(record[0], record[1])
+
+
+class LazyIndex(collections.MutableMapping):
+    """Mapping from key to patch, backed by a sorted column of keys.
+
+    Lookups binary search keys, and build the patch for record
+    records[i].  Changes made after loading are kept in a dictionary
+    in front of the snapshot; None marks a key that was removed.
+    """
+
+    def __init__(self, keys, records, load):
+        self.keys = keys
+        self.records = records
+        self.load = load
+        self.changes = {}
+
+    def find(self, key):
+        """Returns the position of key in keys, or None."""
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return None
+
+    def __getitem__(self, key):
+        if key in self.changes:
+            value = self.changes[key]
+            if value is None:
+                raise KeyError(key)
+            return value
+        i = self.find(key)
+        if i is None:
+            raise KeyError(key)
+        return self.load(self.records[i])
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+
+    def __delitem__(self, key):
+        self[key]
+        self.changes[key] = None
+
+    def __iter__(self):
+        for i in range(len(self.keys)):
+            key = str(self.keys[i])
+            if key not in self.changes:
+                yield key
+        for key, value in self.changes.items():
+            if value is not None:
+                yield key
+
+    def __len__(self):
+        count = len(self.keys)
+        for key, value in self.changes.items():
+            in_snapshot = self.find(key) is not None
+            if value is None and in_snapshot:
+                count -= 1
+            elif value is not None and not in_snapshot:
+                count += 1
+        return count
+
+
+def record_offset(removed, row):
+    """Returns the offset of the record now at row.
+
+    removed is the sorted list of offsets of records removed since
+    loading; later records have moved up to fill their rows.
+    """
+    offset = row
+    while True:
+        shifted = row + bisect.bisect_right(removed, offset)
+        if shifted == offset:
+            return offset
+        offset = shifted
+
+
+class PatchList(collections.Sequence):
+    """A store's list of patches, built from snapshot records on demand.
+
+    Holds the count records starting at first, less any deleted since,
+    then any patches appended since.  Deleting a row only records it, so
+    no patches are built.
+    """
+
+    def __init__(self, snapshot, first, count, added=None, removed=None):
+        self.snapshot = snapshot
+        self.first = first
+        self.count = count
+        self.added = added or []
+        # Sorted offsets from first of the records deleted since loading.
+        self.removed = removed or []
+
+    def __len__(self):
+        return self.count - len(self.removed) + len(self.added)
+
+    def row(self, i):
+        """Returns i as a row number, raising IndexError if out of range."""
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        return i
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            if i == slice(None):
+                return PatchList(self.snapshot, self.first, self.count,
+                                 list(self.added), list(self.removed))
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = self.row(i)
+        kept = self.count - len(self.removed)
+        if i >= kept:
+            return self.added[i - kept]
+        return self.snapshot.patch(self.first +
+                                   record_offset(self.removed, i))
+
+    def __delitem__(self, i):
+        i = self.row(i)
+        kept = self.count - len(self.removed)
+        if i >= kept:
+            del self.added[i - kept]
+        else:
+            bisect.insort(self.removed, record_offset(self.removed, i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, p):
+        self.added.append(p)
+
+
+class SnapshotRows(collections.MutableMapping):
+    """A store's map from patch to row, for patches in a PatchList.
+
+    Deleting a patch moves later rows up, as deleting its row from the
+    PatchList does.
+    """
+
+    def __init__(self, snapshot, first, count, added=None, removed=None):
+        self.snapshot = snapshot
+        self.first = first
+        self.count = count
+        # Map from patch to row for patches added since loading.
+        self.added = added or {}
+        # Sorted offsets from first of the records deleted since loading.
+        self.removed = removed or []
+
+    def __getitem__(self, p):
+        if p in self.added:
+            return self.added[p]
+        offset = self.snapshot.indexes.get(p, -1) - self.first
+        if offset < 0 or offset >= self.count:
+            raise KeyError(p)
+        before = bisect.bisect_left(self.removed, offset)
+        if before < len(self.removed) and self.removed[before] == offset:
+            raise KeyError(p)
+        return offset - before
+
+    def __contains__(self, p):
+        try:
+            self[p]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, p, row):
+        self.added[p] = row
+
+    def __delitem__(self, p):
+        row = self[p]
+        if p in self.added:
+            del self.added[p]
+        else:
+            bisect.insort(self.removed,
+                          self.snapshot.indexes[p] - self.first)
+        for other, other_row in self.added.items():
+            if other_row > row:
+                self.added[other] = other_row - 1
+
+    def __iter__(self):
+        removed = set(self.removed)
+        for offset in range(self.count):
+            if offset not in removed:
+                yield self.snapshot.patch(self.first + offset)
+        for p in sorted(self.added, key=self.added.get):
+            yield p
+
+    def __len__(self):
+        return self.count - len(self.removed) + len(self.added)
+
+    def copy(self):
+        return SnapshotRows(self.snapshot, self.first, self.count,
+                            dict(self.added), list(self.removed))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python2.7
+#
+# Counters and latency histograms for the web server and library loading.
+#
+# Metrics are kept in a Registry and shown by the server at /metrics in
+# the Prometheus text format, so any Prometheus-compatible scraper (or
+# curl) can watch how long loading, parsing, searching and rendering take.
+# Each metric may have labels; every combination of label values is kept
+# separately.
+#
+# Robert Bowdidge, December 2019.
+
+import contextlib
+import threading
+import time
+
+# Prefix on every metric name.
+PREFIX = 'patch_compare_'
+
+# Upper bounds, in seconds, of histogram buckets.  Parsing a single message
+# takes microseconds; loading a library or rendering a page can take
+# seconds.
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Content type of the text format.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    """Returns number as written in the text format."""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def escape_label(value):
+    """Returns label value with backslashes, quotes and newlines escaped."""
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_labels(names, values, extra=()):
+    """Returns {name="value",...} for the labels, or '' if there are none."""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value))
+                             for name, value in pairs)
+
+
+class Metric(object):
+    """Base class for a named metric with optional labels.
+
+    Values for each combination of labels are kept in self.values, keyed
+    by the tuple of label values in the order of label_names.
+    """
+    kind = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = PREFIX + name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        """Returns tuple of label values from keyword arguments."""
+        if set(labels) != set(self.label_names):
+            raise ValueError('%s needs labels %s, not %s' % (
+                self.name, self.label_names, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        """Returns list of (suffix, label string, value) to show."""
+        raise NotImplementedError
+
+    def render(self):
+        """Returns lines describing the metric in the text format."""
+        lines = ['# HELP %s %s' % (self.name, self.help_text),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, labels,
+                                        format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """Count that only goes up."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [('', format_labels(self.label_names, key), value)
+                for key, value in values]
+
+
+class Gauge(Metric):
+    """Value that goes up and down.
+
+    function, if given, is called for the current value whenever the
+    metric is shown, for values such as the size of the library that are
+    easier to look up than to track.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, label_names=(), function=None):
+        Metric.__init__(self, name, help_text, label_names)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.function:
+            return [('', '', self.function())]
+        with self.lock:
+            values = sorted(self.values.items())
+        return [('', format_labels(self.label_names, key), value)
+                for key, value in values]
+
+
+class Histogram(Metric):
+    """Distribution of durations, counted into cumulative buckets."""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # A count per bucket, then +Inf, then the sum.
+                counts = [0] * (len(self.buckets) + 1) + [0.0]
+                self.values[key] = counts
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Context manager observing how long its body takes."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, list(counts))
+                            for key, counts in self.values.items())
+        result = []
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                labels = format_labels(self.label_names, key,
+                                       [('le', format_value(float(bound)))])
+                result.append(('_bucket', labels, total))
+            labels = format_labels(self.label_names, key)
+            result.append(('_sum', labels, counts[-1]))
+            result.append(('_count', labels, total))
+        return result
+
+
+class Registry(object):
+    """Collection of metrics, shown together."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self.add(Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=(), function=None):
+        return self.add(Gauge(name, help_text, label_names, function))
+
+    def histogram(self, name, help_text, label_names=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help_text, label_names, buckets))
+
+    def render(self):
+        """Returns every metric in the Prometheus text format."""
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics for the whole program.
+registry = Registry()
+
+files_found = registry.counter(
+    'files_found_total', 'Patch files found in the patch directories.')
+discovery_seconds = registry.counter(
+    'discovery_seconds_total',
+    'Time spent walking directories for patch files.')
+decode_seconds = registry.histogram(
+    'decode_seconds', 'Time spent decoding each patch file.')
+decode_failures = registry.counter(
+    'decode_failures_total', 'Patch files that could not be decoded.')
+cache_hits = registry.counter(
+    'cache_hits_total', 'Patch files read from the decoded patch cache.')
+patches_decoded = registry.counter(
+    'patches_decoded_total', 'Patches read from patch files.')
+parse_message_seconds = registry.histogram(
+    'parse_message_seconds',
+    'Time spent parsing each sysex message of a patch.')
+details_seconds = registry.histogram(
+    'details_seconds', 'Time spent building the details of one patch.')
+similarity_seconds = registry.histogram(
+    'similarity_seconds', 'Time spent finding similar patches.',
+    ['method'])
+render_seconds = registry.histogram(
+    'render_seconds',
+    'Time spent rendering each template, not counting sending it.',
+    ['template'])
+request_seconds = registry.histogram(
+    'request_seconds', 'Time spent answering each request.', ['route'])
+responses_sent = registry.counter(
+    'responses_total', 'Responses sent, by status code.', ['status'])
+load_seconds = registry.gauge(
+    'load_seconds', 'Time taken to load the library at startup.')
@@ -8,6 +8,38 @@
 # Robert Bowdidge, December 2019.
 
 
+import collections
+import hashlib
+import itertools
+import logging
+import operator
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Version of the parsing rules.  Bump whenever parse() or a definitions
+# table changes, or what a patch records about its sysex messages, so stale
+# entries in the patch cache are ignored.
+PARSER_VERSION = 2
+
+# When true, patches keep their sysex as bytes and decode parameters on
+# demand through a SettingsView instead of filling a settings dictionary.
+# Saves memory with large libraries.
+compact_settings = False
+
+# When true, patches keep their sysex and only fill in their settings
+# dictionary when first asked for a parameter beyond those shown in lists
+# of patches.  Speeds up loading libraries where few patches are opened.
+# Ignored in compact_settings mode.
+lazy_settings = False
+
+# Held while a LazySettings fills in its dictionary, so concurrent
+# requests for the same patch don't parse its messages out of order.
+_lazy_parse_lock = threading.Lock()
+
 # Classification of different CC variables.  Used to control presentation.
 
 # Uninteresting part of patch.  Unprocessed.
@@ -36,11 +68,283 @@ PLUS_MINUS_PERCENT_TYPE=6
 # CC represents a value from 0% to 100%.
 PERCENT_TYPE=7
 
+# Functions converting raw bytes to values for each type of parameter.
+_converters = {
+    PLUS_MINUS_TYPE: lambda v: v - 64,
+    PLUS_MINUS_PERCENT_TYPE: lambda v: 100 * (v - 64) / 64,
+    PERCENT_TYPE: lambda v: 100 * v / 124,
+}
+
+def _raw(value):
+    return value
+
+def _getter(offsets):
+    """Returns function fetching the bytes at offsets as a tuple."""
+    if len(offsets) == 1:
+        offset = offsets[0]
+        return lambda sysex: (sysex[offset],)
+    if not offsets:
+        return lambda sysex: ()
+    return operator.itemgetter(*offsets)
+
+
+class ParsePlan(object):
+    """A definitions table compiled for parsing many patches.
+
+    Patch.parse used to walk the definitions for every patch, building
+    labels and checking types as it went.  The plan does that work once:
+    it precomputes full labels and absolute offsets, and groups parameters
+    by type.  Parsing a patch is then one C-level fetch of all the bytes
+    for each group.
+    """
+
+    def __init__(self, definitions, cc_offset):
+        # Last rule wins if a label appears twice, as in the old parse loop.
+        rules = {}
+        blocks = {}
+        order = []
+        for rule in definitions:
+            try:
+                block, label, offset, bytes, type = rule
+            except Exception as e:
+                logger.warning('problems parsing %s:%s', rule, e)
+                continue
+            full_label = '%s_%s' % (block, label)
+            if full_label not in rules:
+                order.append(full_label)
+            rules[full_label] = (cc_offset + offset, bytes, type)
+            blocks[full_label] = block
+
+        # List of (full_label, absolute offset, bytes, type).
+        self.rules = [(label,) + rules[label] for label in order]
+
+        # Map from full_label to the block it belongs to, such as osc1 or
+        # mod_matrix_2.  Labels can't be split to find it, since block
+        # names themselves hold underscores.
+        self.blocks = blocks
+
+        self.numeric_labels = [label + '_numeric'
+                               for label, _, _, _ in self.rules]
+        self.numeric_getter = _getter(
+            [offset for _, offset, _, _ in self.rules])
+
+        # Map from type to (labels, getter) for single byte parameters.
+        self.groups = {}
+        for group_type in [POSITIVE_TYPE, PLUS_MINUS_TYPE,
+                           PLUS_MINUS_PERCENT_TYPE, PERCENT_TYPE]:
+            group = [(label, offset) for label, offset, _, type in self.rules
+                     if type == group_type]
+            self.groups[group_type] = (
+                [label for label, _ in group],
+                _getter([offset for _, offset in group]))
+        # Everything else that isn't a string or ignored is kept raw.
+        group = [(label, offset) for label, offset, _, type in self.rules
+                 if type not in self.groups and
+                 type not in [STRING_TYPE, NONE_TYPE]]
+        self.groups[None] = ([label for label, _ in group],
+                             _getter([offset for _, offset in group]))
+
+        # List of (label, start, end) for string parameters.
+        self.strings = [(label, offset, offset + bytes)
+                        for label, offset, bytes, type in self.rules
+                        if type == STRING_TYPE]
+
+        # Map from every settings key to (start, end, type), for decoding
+        # single values.  type is None for the _numeric keys.
+        self.index = {}
+        for label, offset, bytes, type in self.rules:
+            self.index[label + '_numeric'] = (offset, offset + 1, None)
+            if type != NONE_TYPE:
+                self.index[label] = (offset, offset + bytes, type)
+
+    def value(self, sysex, key):
+        """Returns the value of one settings key from sysex held as bytes.
+
+        Raises KeyError for keys not in the plan.
+        """
+        start, end, type = self.index[key]
+        if type == STRING_TYPE:
+            return sysex[start:end].strip()
+        return _converters.get(type, _raw)(ord(sysex[start]))
+
+    def parse(self, sysex, the_dict):
+        """Adds the parameters in sysex to the_dict."""
+        izip = itertools.izip
+        the_dict.update(izip(self.numeric_labels, self.numeric_getter(sysex)))
+
+        labels, getter = self.groups[None]
+        the_dict.update(izip(labels, getter(sysex)))
+        labels, getter = self.groups[POSITIVE_TYPE]
+        the_dict.update(izip(labels, getter(sysex)))
+        labels, getter = self.groups[PLUS_MINUS_TYPE]
+        the_dict.update(izip(labels, [v - 64 for v in getter(sysex)]))
+        labels, getter = self.groups[PLUS_MINUS_PERCENT_TYPE]
+        the_dict.update(izip(labels,
+                             [100 * (v - 64) / 64 for v in getter(sysex)]))
+        labels, getter = self.groups[PERCENT_TYPE]
+        the_dict.update(izip(labels, [100 * v / 124 for v in getter(sysex)]))
+
+        for label, start, end in self.strings:
+            the_dict[label] = str(sysex[start:end]).strip()
+
+
+# Map from (id of definitions, cc_offset) to (definitions, ParsePlan).
+_parse_plans = {}
+
+def parse_plan(definitions, cc_offset):
+    """Returns the ParsePlan for a definitions table, compiling it once."""
+    key = (id(definitions), cc_offset)
+    entry = _parse_plans.get(key)
+    if entry is None or entry[0] is not definitions:
+        entry = (definitions, ParsePlan(definitions, cc_offset))
+        _parse_plans[key] = entry
+    return entry[1]
+
+
+class SettingsView(collections.MutableMapping):
+    """Settings of a compact patch, decoded from its sysex when asked for.
+
+    Behaves like the settings dictionary filled in by Patch.parse.  Values
+    that aren't in the sysex, such as the device name or the settings for
+    a group, are held in a small dictionary of extras.
+    """
+    __slots__ = ('plan', 'sysex', 'extra')
+
+    def __init__(self, plan, sysex, extra=None):
+        # ParsePlan shared by all patches of the same kind.
+        self.plan = plan
+        # Sysex message as bytes.
+        self.sysex = sysex
+        # Dictionary of values not decoded from sysex.
+        self.extra = extra or {}
+
+    def __getitem__(self, key):
+        if key in self.extra:
+            return self.extra[key]
+        return self.plan.value(self.sysex, key)
+
+    def __contains__(self, key):
+        return key in self.extra or key in self.plan.index
+
+    def __setitem__(self, key, value):
+        self.extra[key] = value
+
+    def __delitem__(self, key):
+        del self.extra[key]
+
+    def __iter__(self):
+        return itertools.chain(
+            self.extra,
+            (key for key in self.plan.index if key not in self.extra))
+
+    def __len__(self):
+        return len(self.extra) + len(
+            [key for key in self.plan.index if key not in self.extra])
+
+
+class LazySettings(collections.MutableMapping):
+    """Settings of a lazy patch, parsed in full when first needed.
+
+    Behaves like the settings dictionary filled in by Patch.parse.
+    Messages are only recorded as they arrive.  Keys in summary_keys, and
+    values set directly such as the device name, are answered without
+    parsing; the first request for anything else parses every message
+    into the dictionary, which then answers everything.
+    """
+    __slots__ = ('summary_keys', 'pending', 'values')
+
+    def __init__(self, summary_keys, values=None):
+        # Keys decoded one at a time from the main message until parsed.
+        self.summary_keys = summary_keys
+        # List of (plan, sysex, group_key) for messages not yet parsed, or
+        # None once they have been.
+        self.pending = []
+        # Settings dictionary; complete once pending is None.
+        self.values = values or {}
+
+    def add(self, plan, sysex, group_key):
+        """Records a message to parse later."""
+        if self.pending is None:
+            parse_message(plan, sysex, group_key, self.values)
+        else:
+            self.pending.append((plan, sysex, group_key))
+
+    def parse(self):
+        """Fills in the dictionary from every recorded message."""
+        with _lazy_parse_lock:
+            if self.pending is None:
+                return
+            for plan, sysex, group_key in self.pending:
+                parse_message(plan, sysex, group_key, self.values)
+            self.pending = None
+
+    def __getitem__(self, key):
+        # Another thread may finish parsing at any moment.
+        pending = self.pending
+        if pending is not None:
+            if key in self.values:
+                return self.values[key]
+            if key in self.summary_keys:
+                # Decode just this value from the last main message.
+                for plan, sysex, group_key in reversed(pending):
+                    if not group_key and key in plan.index:
+                        return plan.value(str(sysex), key)
+            self.parse()
+        return self.values[key]
+
+    def __contains__(self, key):
+        pending = self.pending
+        if pending is None or key in self.values:
+            return key in self.values
+        for plan, _, group_key in pending:
+            if key == group_key or (not group_key and key in plan.index):
+                return True
+        return False
+
+    def __setitem__(self, key, value):
+        if self.pending is not None and key not in self.values and key in self:
+            # A parameter; parsing later mustn't overwrite it.
+            self.parse()
+        self.values[key] = value
+
+    def __delitem__(self, key):
+        self.parse()
+        del self.values[key]
+
+    def __iter__(self):
+        self.parse()
+        return iter(self.values)
+
+    def __len__(self):
+        self.parse()
+        return len(self.values)
+
+
+def parse_message(plan, sysex, group_key, settings):
+    """Adds the parameters in one message to a settings dictionary."""
+    start = time.time()
+    if group_key:
+        if group_key not in settings:
+            settings[group_key] = {}
+        settings = settings[group_key]
+    plan.parse(sysex, settings)
+    metrics.parse_message_seconds.observe(time.time() - start)
+    return settings
+
+
 class Patch(object):
     """Base class for all synthesizer-specific patches.
 
     Callers should override __init__ at a minimum.
     """
+    __slots__ = ('filepath', 'is_favorite', 'settings', 'definitions',
+                 'select_styles', 'collection', 'name', 'sysex', 'messages',
+                 'cc_offset', 'manufacturer_string', 'device', 'view_cache',
+                 'summary_cache', 'locations')
+
+    # Settings shown for each patch in lists of patches, as on the root
+    # page.
+    summary_keys = ['patch_name']
 
     def __init__(self, filepath, cc_offset=0, collection=''):
         # Full path to location of file containing patch.
@@ -49,7 +353,9 @@ class Patch(object):
         # True if favorite of user.
         self.is_favorite = False
 
-        # Dictionary containing map of cc names to 0-127 values.
+        # Dictionary containing map of cc names to 0-127 values.  A
+        # SettingsView instead in compact_settings mode, and a LazySettings
+        # in lazy_settings mode.
         self.settings = {}
 
         # Array of valid cc names and locations in file.
@@ -78,9 +384,23 @@ class Patch(object):
         # Name of patch.
         self.name = 'unknown'
 
+        # List of (collection, filepath) for every copy of this patch in the
+        # library, starting with this one.  Filled in when the patch is
+        # added to the library.
+        self.locations = []
+
         # Raw MIDI command for patch.
         self.sysex = None
 
+        # List of (group_key, sysex) for every message parsed, so the patch
+        # can be rebuilt.
+        self.messages = []
+
+        # (stamp, dictionary) for the last results of details() and
+        # summary().  See view_stamp().
+        self.view_cache = None
+        self.summary_cache = None
+
         # Offset between indexes in file and CCs.
         # TODO(bowdidge): Remove.
         self.cc_offset = cc_offset
@@ -100,11 +420,13 @@ class Patch(object):
 
         out['is_favorite'] = self.is_favorite
         out['collection'] = self.collection
+        out['locations'] = list(self.locations)
         out['device'] = self.settings['device']
         out['source'] = self.settings['source']
-        out['hex_dump'] = dump_hex(self.sysex)
+        sysex = bytearray(self.sysex)
+        out['hex_dump'] = dump_hex(sysex)
         out['manufacturer_string'] = self.manufacturer_string
-        out['sysex'] = ''.join([ '%%%02x' % c for c in self.sysex])
+        out['sysex'] = ''.join([ '%%%02x' % c for c in sysex])
 
         the_dict = self.settings
         if group_key:
@@ -117,15 +439,73 @@ class Patch(object):
             key = '%s_%s' % (block, label)
             if key not in the_dict:
                 continue
-            if type == SELECT_TYPE:
-                out[key] = self.select_label(key, the_dict[key])
-            elif type == ON_OFF_TYPE:
-                if the_dict[key] == 0:
-                    out[key] = 'off'
-                else:
-                    out[key] = 'on'
-            else:
-                out[key] = the_dict[key]
+            out[key] = self.display_value(key, the_dict[key], type)
+        return out
+
+    def display_value(self, key, value, type):
+        """Returns a settings value in the form shown to users."""
+        if type == SELECT_TYPE:
+            return self.select_label(key, value)
+        elif type == ON_OFF_TYPE:
+            if value == 0:
+                return 'off'
+            return 'on'
+        return value
+
+    def view_stamp(self):
+        """Returns a value that changes whenever asDict's result would.
+
+        Parsing another message, or changing the name, favorite,
+        collection or locations, changes the stamp and so throws away
+        cached views.
+        """
+        return (len(self.messages), self.name, self.is_favorite,
+                self.collection, tuple(self.locations))
+
+    def content_hash(self):
+        """Returns a hash identifying the sound of the patch.
+
+        Covers the parameter bytes of each message, skipping the header
+        (device id, bank and slot) and the trailing checksum, so copies of
+        a patch saved to other slots or files match.
+        """
+        digest = hashlib.sha1(self.device)
+        for group_key, sysex in self.messages:
+            digest.update('%s:' % (group_key or ''))
+            digest.update(bytes(sysex[self.cc_offset:-2]))
+        return digest.hexdigest()
+
+    def details(self):
+        """Returns asDict() for the patch, reusing the last result.
+
+        Callers must not change the returned dictionary.
+        """
+        stamp = self.view_stamp()
+        if self.view_cache is None or self.view_cache[0] != stamp:
+            with metrics.details_seconds.time():
+                self.view_cache = (stamp, self.asDict())
+        return self.view_cache[1]
+
+    def summary(self):
+        """Returns the part of asDict() shown in lists of patches.
+
+        Skips the hex dump, graphs and other details, which are slow to
+        build.  Callers must not change the returned dictionary.
+        """
+        stamp = self.view_stamp()
+        if self.summary_cache is not None and self.summary_cache[0] == stamp:
+            return self.summary_cache[1]
+        out = {}
+        out['name'] = self.name
+        out['is_favorite'] = self.is_favorite
+        out['collection'] = self.collection
+        out['device'] = self.settings['device']
+        index = parse_plan(self.definitions, self.cc_offset).index
+        for key in self.summary_keys:
+            if key in self.settings:
+                out[key] = self.display_value(key, self.settings[key],
+                                              index[key][2])
+        self.summary_cache = (stamp, out)
         return out
 
     def adsr_graph(self, attack, decay, sustain, sustain_time, release):
@@ -219,12 +599,12 @@ class Patch(object):
         present.
         """
         if label not in self.select_styles:
-            print 'no style for %s' % label
+            logger.debug('no style for %s', label)
             return str(value)
 
         label_dict = self.select_styles[label]
         if value not in label_dict:
-            print '%s: No label in %s for %d' % (self.name, label, value)
+            logger.debug('%s: No label in %s for %d', self.name, label, value)
             return str(value)
 
         return '%s (%d)' % (label_dict[value], value)
@@ -237,40 +617,32 @@ class Patch(object):
         """
         if not definitions:
             definitions = self.definitions
+        plan = parse_plan(definitions, self.cc_offset)
+        if compact_settings:
+            sysex = bytes(sysex)
         self.sysex = sysex
-        start_offset = self.cc_offset
-        the_dict = self.settings
-        if group_key:
-            if group_key not in self.settings:
-                self.settings[group_key] = {}
-            the_dict = self.settings[group_key]
+        self.messages.append((group_key, sysex))
 
-        for rule in definitions:
-            # print rule
-            try:
-                block, label, offset, bytes, type = rule
-            except Exception as e:
-                print 'problems parsing %s:%s' % (rule, e)
-                continue
-            full_label = '%s_%s' % (block, label)
-            
-            the_dict[full_label + '_numeric'] = self.sysex[start_offset + offset]
-            if type is STRING_TYPE:
-                the_dict[full_label] = str(self.sysex[start_offset + offset:start_offset + offset + bytes]).strip()
-            elif type is NONE_TYPE:
-                pass
-            elif type is POSITIVE_TYPE:
-                # assume length is 1.
-                the_dict[full_label] = self.sysex[start_offset + offset]
-            elif type is PLUS_MINUS_TYPE:
-                the_dict[full_label] = self.sysex[start_offset + offset] - 64
-            elif type is PLUS_MINUS_PERCENT_TYPE:
-                the_dict[full_label] = 100 * (self.sysex[start_offset + offset] - 64) / 64
-            elif type is PERCENT_TYPE:
-                the_dict[full_label] = (100 * self.sysex[start_offset + offset]  / 124)
+        if compact_settings:
+            view = SettingsView(plan, sysex)
+            if group_key:
+                self.settings[group_key] = view
             else:
-                the_dict[full_label] = self.sysex[start_offset + offset]
-        return the_dict
+                view.extra.update(self.settings)
+                self.settings = view
+            return view
+
+        if lazy_settings:
+            if not isinstance(self.settings, LazySettings):
+                self.settings = LazySettings(self.summary_keys, self.settings)
+            self.settings.add(plan, sysex, group_key)
+            return self.settings
+
+        return parse_message(plan, sysex, group_key, self.settings)
+
+    def group_definitions(self, group_key):
+        """Returns the definitions used to parse messages for group_key."""
+        return self.definitions
 
     def print_patch(self):
         """Print the patch in a human-readable text format."""
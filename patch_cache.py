@@ -0,0 +1,131 @@
+#!/usr/bin/env python2.7
+#
+# On-disk cache of decoded patches.
+#
+# Decoding every patch file at launch is slow for big libraries.  The cache
+# remembers the raw sysex and parsed settings of the patches found in each
+# file, keyed by the file's path, modification time and size, and the
+# parser version.  Files that haven't changed since the last launch are
+# rebuilt from the cache without reading them with mido.
+#
+# Robert Bowdidge, December 2019.
+
+import cPickle
+import os
+import sqlite3
+import sys
+
+import access_patch
+import patch
+import refacedx_patch
+
+# Map from device name to class for patches of that device.
+PATCH_CLASSES = {
+    'virus': access_patch.AccessPatch,
+    'refacedx': refacedx_patch.RefaceDXPatch,
+}
+
+CACHE_FILENAME = 'patches.sqlite'
+
+
+def default_cache_dir():
+    """Returns the per-user directory for Patch Compare's cache."""
+    if sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME',
+                              os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'patch_compare')
+
+
+def to_record(p):
+    """Returns a tuple holding everything needed to rebuild a patch.
+
+    Parsed settings are only kept for patches with a settings dictionary;
+    compact and lazy patches are rebuilt by parsing their messages again.
+    """
+    settings = None
+    if isinstance(p.settings, dict):
+        settings = p.settings
+    return (p.device, p.filepath, p.name, p.collection,
+            [(group_key, bytes(sysex)) for group_key, sysex in p.messages],
+            settings)
+
+
+def from_record(record):
+    """Returns a patch rebuilt from a tuple made by to_record."""
+    device, filepath, name, collection, messages, settings = record
+    p = PATCH_CLASSES[device](filepath)
+    p.name = name
+    p.collection = collection
+    if patch.compact_settings or patch.lazy_settings or settings is None:
+        for group_key, sysex in messages:
+            p.parse(bytearray(sysex), p.group_definitions(group_key),
+                    group_key)
+        return p
+    p.messages = [(group_key, bytearray(sysex))
+                  for group_key, sysex in messages]
+    p.sysex = p.messages[-1][1]
+    p.settings.update(settings)
+    return p
+
+
+class PatchCache(object):
+    """SQLite database of decoded patches for each patch file."""
+
+    def __init__(self, cache_dir=None):
+        if not cache_dir:
+            cache_dir = default_cache_dir()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.db = sqlite3.connect(os.path.join(cache_dir, CACHE_FILENAME),
+                                  check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files ('
+                        '  path TEXT PRIMARY KEY,'
+                        '  mtime REAL,'
+                        '  size INTEGER,'
+                        '  parser_version INTEGER,'
+                        '  patches BLOB)')
+
+    def get(self, filepath):
+        """Returns list of cached patches for a file.
+
+        Returns None if the file isn't cached, or has changed since it was
+        cached.
+        """
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+        row = self.db.execute(
+            'SELECT patches FROM files WHERE path = ? AND mtime = ? AND '
+            'size = ? AND parser_version = ?',
+            (os.path.abspath(filepath), stat.st_mtime, stat.st_size,
+             patch.PARSER_VERSION)).fetchone()
+        if row is None:
+            return None
+        return [from_record(r) for r in cPickle.loads(str(row[0]))]
+
+    def put(self, filepath, patches):
+        """Records the patches decoded from a file."""
+        stat = os.stat(filepath)
+        records = [to_record(p) for p in patches]
+        self.db.execute(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+            (os.path.abspath(filepath), stat.st_mtime, stat.st_size,
+             patch.PARSER_VERSION,
+             sqlite3.Binary(cPickle.dumps(records,
+                                          cPickle.HIGHEST_PROTOCOL))))
+
+    def remove(self, filepath):
+        """Forgets the patches for a file that no longer exists."""
+        self.db.execute('DELETE FROM files WHERE path = ?',
+                        (os.path.abspath(filepath),))
+
+    def commit(self):
+        """Writes pending changes to disk."""
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -9,21 +9,128 @@
 #
 # Robert Bowdidge, December 2019.
 
+import argparse
 import BaseHTTPServer
-import glob
+import collections
+import itertools
 import jinja2 as jinja
-import mido
+import logging
+import multiprocessing
 import os
 import sys
+import threading
+import time
 import urllib
 import urlparse
+import zlib
 
 import access_patch
+import api
+import clustering
+import concurrency
+import discovery
+import library_snapshot
+import metrics
+import patch
+import patch_cache
+import patch_store
 import refacedx_patch
+import responses
+import similarity
+import sysex_reader
+import watcher
 
-# Map from short name to full name.
+logger = logging.getLogger('patch_compare')
+
+# Map from name to patch.  Each distinct sound gets a name no other sound
+# has; see name_patch.  A plain name may also lead to a renamed sound once
+# the sound first holding it is gone.
 all_patches = {}
 
+# Map from content hash to the one patch kept for all copies of a sound.
+unique_patches = {}
+
+# Map from name read from patch files to the patches renamed because
+# another sound already had that name, in the order they were added.
+name_variants = {}
+
+# Map from patch file to content hashes of the patches decoded from it, so
+# a changed file's old copies can be dropped.  Only touched by the thread
+# loading files.
+file_patches = {}
+
+# Guards all_patches and the stores and indexes derived from it.  Request
+# handlers hold it for reading; anything changing the library holds it for
+# writing.
+library_lock = concurrency.ReadWriteLock()
+
+# Counts changes to the library.  API responses are tagged with it, so a
+# client's copy stays valid until the library changes.  Combined with the
+# launch time so tags from an earlier run don't match.
+library_version = 0
+LAUNCH_TIME = int(time.time())
+
+# Map from device name to PatchStore holding that device's patches.
+patch_stores = {}
+
+# Map from device name to SimilarityEngine for that device's patches.
+similarity_engines = {}
+
+# Map from device name to LSHIndex for approximate similarity searches.
+# Only filled in for devices with more patches than --approximate-above.
+lsh_indexes = {}
+
+# Map from device name to list of groups of similar patches saved by
+# group_patches.py.  See clustering.make_groups.
+patch_groups = {}
+
+# Map from content hash to (device, index in patch_groups[device]).
+patch_group_index = {}
+
+# Map from device name to precomputed NeighbourTable.  Only filled in when
+# run with --precompute-similar.
+neighbour_tables = {}
+
+# Hex digits of the content hash added to the name of a sound whose name
+# is already taken.
+NAME_HASH_LENGTH = 8
+
+# Number of similar patches shown on a patch page.
+SIMILAR_COUNT = 10
+
+# Number of rows on each page of the root page, unless the query says
+# otherwise.
+PAGE_SIZE = 500
+
+# Query keys on the root page and /api/patches that aren't filters on patch
+# parameters.
+ROOT_QUERY_KEYS = ['collection', 'device', 'page', 'per_page', 'sort',
+                   'order', 'fields']
+
+# Number of template fragments gathered into each chunk when streaming.
+STREAM_BUFFER_SIZE = 64
+
+# Number of files each decoding process may work on ahead of the file
+# being added to the library.
+LOAD_AHEAD = 4
+
+# Templates loaded when the server starts.
+TEMPLATES = ['root.html', 'access_virus.html', 'reface_dx.html',
+             'groups.html']
+
+# Choices for --log-level.
+LOG_LEVELS = ['debug', 'info', 'warning', 'error']
+
+# Size of the library, looked up whenever /metrics is shown.  The server
+# holds library_lock for reading while it is.
+metrics.registry.gauge('patches', 'Patches in the library, one per sound.',
+                       function=lambda: len(unique_patches))
+metrics.registry.gauge('patch_names', 'Patch names in the library.',
+                       function=lambda: len(all_patches))
+metrics.registry.gauge('library_version',
+                       'Changes to the library since startup.',
+                       function=lambda: library_version)
+
 def try_filter(patch_list, query_key, query_value):
     """Returns a filtered version of patch list.
 
@@ -41,14 +148,15 @@ def try_filter(patch_list, query_key, query_value):
             b = str(x.get(query_key_numeric))
             
             if a == query_value or b == query_value:
-                print query_value, x.get(query_key), x.get(query_key_numeric)
+                logger.debug('%s matches %s %s', query_value,
+                             x.get(query_key), x.get(query_key_numeric))
                 result.append(x)
         return result
     greater_equal = 'ge' in query_value
     try:
         base_value = int(query_value.replace('ge', '').replace('le', ''))
     except Exception as e:
-        print 'Bad query %s' % query_value
+        logger.warning('Bad query %s', query_value)
         return patch_list
     new_list = []
     for x in patch_list:
@@ -71,21 +179,84 @@ class PatchCompareHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         filename is name of file containing template.
         variables is dictionary of variables available to template.
         """
-        file_loader = jinja.FileSystemLoader('templates')
-        env = jinja.Environment(loader=file_loader)
-        template = env.get_template(filename)
+        template = template_environment.get_template(filename)
+
+        with metrics.render_seconds.time(template=filename):
+            return template.render(variables)
+
+    def stream_template(self, filename, variables, prefix='', etag=None):
+        """Sends a 200 response with a template, rendering as it goes.
+
+        HTTP/1.1 clients get the page with chunked transfer encoding, so
+        they can start showing it before rendering finishes.  Compressed
+        pages are flushed at the end of each chunk for the same reason.
+        """
+        template = template_environment.get_template(filename)
+        chunked = self.request_version == 'HTTP/1.1'
+        if chunked:
+            self.protocol_version = 'HTTP/1.1'
+        encoding = responses.negotiate_encoding(
+            self.headers.get('Accept-Encoding'))
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_cache_headers(responses.encoded_etag(etag, encoding))
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.send_header('Connection', 'close')
+        self.end_headers()
 
-        return template.render(variables)
+        compressor = None
+        if encoding:
+            compressor = responses.compressor(encoding)
+        parts = render_stream(template, filename, variables)
+        for part in itertools.chain([prefix], parts, [None]):
+            if part is None:
+                # End of the page.
+                if not compressor:
+                    continue
+                data = compressor.flush()
+            else:
+                data = part.encode('utf-8')
+                if compressor:
+                    data = (compressor.compress(data) +
+                            compressor.flush(zlib.Z_SYNC_FLUSH))
+            if not data:
+                continue
+            if chunked:
+                self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+            else:
+                self.wfile.write(data)
+        if chunked:
+            self.wfile.write('0\r\n\r\n')
+        self.close_connection = 1
 
     def do_GET(self):
         path = urlparse.urlparse(self.path).path
-        print path
-        if path.startswith('/patch'):
-            return self.get_patch()
-        elif path == '/':
-            return self.get_root()
-        else:
-            return self.get_404()
+        route = request_route(path)
+        with metrics.request_seconds.time(route=route):
+            if route == 'api':
+                return self.get_api(path)
+            elif route == 'patch':
+                return self.get_patch()
+            elif route == 'root':
+                return self.get_root()
+            elif route == 'groups':
+                return self.get_groups()
+            elif route == 'metrics':
+                return self.get_metrics()
+            else:
+                return self.get_404()
+
+    def send_response(self, code, message=None):
+        metrics.responses_sent.inc(status=code)
+        BaseHTTPServer.BaseHTTPRequestHandler.send_response(self, code,
+                                                            message)
+
+    def log_message(self, format, *args):
+        """Logs each request, rather than writing it to stderr."""
+        logger.info('%s %s', self.address_string(), format % args)
 
     def get_404(self):
         """Return a "not found" error."""
@@ -94,118 +265,732 @@ class PatchCompareHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write('<html><head><title>Unknown page</title>')
 
-    def get_root(self):
-        """Renders and returns the main root page listing patches."""
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
+    def get_metrics(self):
+        """Returns counters and timings in the Prometheus text format."""
+        with library_lock.reading():
+            content = metrics.registry.render()
+        self.send_content(200, content, metrics.CONTENT_TYPE)
+
+    def send_cache_headers(self, etag=None):
+        """Sends the headers letting clients cache a response."""
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Cache-Control', responses.CACHE_CONTROL)
+        self.send_header('Vary', 'Accept-Encoding')
+
+    def not_modified(self, etag):
+        """Sends a 304 and returns True if the client's copy is current.
+
+        The client may hold the body compressed the way it would be sent
+        now, or uncompressed, which small bodies always are.
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        encoding = responses.negotiate_encoding(
+            self.headers.get('Accept-Encoding'))
+        for tag in [responses.encoded_etag(etag, encoding), etag]:
+            if responses.etag_matches(if_none_match, tag):
+                self.send_response(304)
+                self.send_cache_headers(tag)
+                self.end_headers()
+                return True
+        return False
+
+    def send_content(self, status, content, content_type, etag=None):
+        """Sends a complete response, compressed if the client allows."""
+        encoding = None
+        if len(content) >= responses.MIN_COMPRESS_SIZE:
+            encoding = responses.negotiate_encoding(
+                self.headers.get('Accept-Encoding'))
+        if encoding:
+            content = responses.compress(content, encoding)
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_cache_headers(responses.encoded_etag(etag, encoding))
         self.end_headers()
-        self.wfile.write('<html><head><title>Title</title>')
+        self.wfile.write(content)
+
+    def send_json(self, status, value, etag=None):
+        """Sends a response holding value as JSON."""
+        self.send_content(status, api.dumps(value), 'application/json', etag)
+
+    def get_api(self, path):
+        """Answers /api/ requests with JSON.
+
+        /api/patches takes the same query as the root page.
+        /api/patch/<name> returns one patch, and /api/similar/<name>?k=N
+        the N patches nearest it.  fields=a,b limits each patch to the
+        fields listed.
+
+        Responses carry an ETag that changes only when the library does;
+        a request whose If-None-Match holds the current tag gets a 304
+        without anything being looked up.
+        """
+        etag = responses.make_etag(library_tag(), self.path)
+        if self.not_modified(etag):
+            return
+
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        fields = api.parse_fields(query)
+        name = None
+        for prefix in ['/api/patch/', '/api/similar/']:
+            if path.startswith(prefix):
+                name = urllib.unquote(path[len(prefix):])
+
+        with library_lock.reading():
+            if path == '/api/patches':
+                page = query_int(query, 'page', 1, minimum=1)
+                per_page = query_int(query, 'per_page', PAGE_SIZE, minimum=1)
+                patches = find_root_patches(query)
+                first = (page - 1) * per_page
+                value = {'total': len(patches),
+                         'patches': [api.patch_json(p, fields) for p in
+                                     patches[first:first + per_page]]}
+            elif name in all_patches:
+                p = all_patches[name]
+                if path.startswith('/api/patch/'):
+                    value = api.patch_json(p, fields)
+                else:
+                    count = query_int(query, 'k', SIMILAR_COUNT, minimum=1)
+                    similar = find_similar_patches(p, count)
+                    blocks = similarity_engines[p.device].block_distances(
+                        p, [other for other, _ in similar])
+                    value = api.similar_json(p, similar, fields, blocks)
+            else:
+                return self.send_json(404, {'error': 'not found'})
+        self.send_json(200, value, etag)
+
+    def get_root(self):
+        """Renders and returns the main root page listing patches.
+
+        Besides filters, the query can hold page and per_page to pick
+        which rows to show, and sort and order (asc or desc) to pick the
+        order of rows.  The page is streamed to the browser as it is
+        rendered.
+        """
+        etag = responses.make_etag(library_tag(), template_version(),
+                                   self.path)
+        if self.not_modified(etag):
+            return
 
         query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
         collections = query.get('collection', [])
-        devices = query.get('device', [])
-        
-        patch_list = [x.asDict() for x in all_patches.values()]
-
-        if collections:
-            patch_list = [x for x in patch_list
-                          if x.get('collection') in collections]
-        if devices:
-            patch_list = [x for x in patch_list
-                          if x.get('device') in devices]
-
-        for key in query:
-            values = query[key]
-            if key not in ['collection', 'device']:
-                for value in values:
-                    patch_list = try_filter(patch_list, key, value)
-
-        patch_list = sorted(patch_list, key=lambda x: x.get('patch_name'))
+        sort_key = query.get('sort', ['name'])[0]
+        descending = query.get('order', ['asc'])[0] == 'desc'
+        page = query_int(query, 'page', 1, minimum=1)
+        per_page = query_int(query, 'per_page', PAGE_SIZE, minimum=1)
+
+        with library_lock.reading():
+            patches = find_root_patches(query)
+            total = len(patches)
+            first = (page - 1) * per_page
+            patch_list = [x.summary()
+                          for x in patches[first:first + per_page]]
+
+        def page_url(**changes):
+            new_query = dict(query)
+            new_query.update((key, [str(value)])
+                             for key, value in changes.items())
+            return '/?' + urllib.urlencode(new_query, doseq=True)
+
+        previous_url = None
+        if first > 0:
+            previous_url = page_url(page=page - 1)
+        next_url = None
+        if first + per_page < total:
+            next_url = page_url(page=page + 1)
+        sort_urls = dict(
+            (key, page_url(sort=key, page=1,
+                           order='desc' if (key == sort_key and
+                                            not descending) else 'asc'))
+            for key in ['name', 'collection', 'device', 'patch_category_1'])
+
         variables = {'patches': patch_list,
-                     'collections': collections}
-        content = self.render_template('root.html', variables)
-        self.wfile.write(content)
+                     'collections': collections,
+                     'first_row': min(first + 1, total),
+                     'last_row': first + len(patch_list),
+                     'total_rows': total,
+                     'previous_url': previous_url,
+                     'next_url': next_url,
+                     'sort_urls': sort_urls,
+                     'has_groups': bool(patch_groups)}
+        self.stream_template('root.html', variables,
+                             '<html><head><title>Title</title>', etag)
 
-        
     def get_patch(self):
-        """Renders page describing patch."""
+        """Renders page describing patch.
+
+        The page is tagged with a hash of the patch's sysex, the library
+        version (which decides the similar patches) and the templates, so
+        a browser revisiting an unchanged page gets a 304.
+        """
         patch_name = self.path.replace('/patch/', '')
         patch_name = urllib.unquote(patch_name)
-        print patch_name
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write('<html><head><title>Patch</title>')
 
-        patch = all_patches.get(patch_name)
+        with library_lock.reading():
+            patch = all_patches.get(patch_name)
+            if patch is None:
+                return self.get_404()
+            etag = responses.make_etag(
+                library_tag(), template_version(), patch.name,
+                repr((patch.is_favorite, patch.collection)),
+                *[bytes(sysex) for _, sysex in patch.messages])
+            if self.not_modified(etag):
+                return
 
-        similar_patches = []
-        similar_count = 10
-        for other_name in all_patches:
-            if other_name == patch_name:
-                continue
-            other = all_patches.get(other_name)
-            if other.device != patch.device:
-                continue
-            if len(similar_patches) < similar_count:
-                similar_patches.append((other, patch.compare(other)))
-            smaller = False
-            compare_score = patch.compare(other)
-            for (s, s_score) in similar_patches:
-                if compare_score < s_score:
-                    smaller = True
-            if smaller:
-                similar_patches.append((other, compare_score))
-                similar_patches_and_scores = sorted(similar_patches,
-                                         key=lambda x: x[1])[0:similar_count]
-
-        similar_patches = [x for x,y in similar_patches_and_scores]
-        for similar_patch in similar_patches:
-            print patch.compare_categories(similar_patch)
-
-        patch_dict = patch.asDict()
+            similar_patches_and_scores = find_similar_patches(patch,
+                                                              SIMILAR_COUNT)
+            similar_blocks = similarity_engines[patch.device].block_distances(
+                patch, [p for p, _ in similar_patches_and_scores])
+            group = patch_group(patch)
+
+            patch_dict = patch.details()
         variables = {'patch_name': patch_dict.get('patch_name'),
                      'patch': patch_dict,
-                     'similar_patches': similar_patches_and_scores}
+                     'similar_patches': similar_patches_and_scores,
+                     'similar_blocks': similar_blocks,
+                     'group': group}
         template = 'patch.html'
         if patch.settings['device'] == 'virus':
             template = 'access_virus.html'
         else:
             template = 'reface_dx.html'
         content = self.render_template(template, variables)
-        self.wfile.write(content)
+        self.send_content(200, ('<html><head><title>Patch</title>' +
+                                content).encode('utf-8'),
+                          'text/html', etag)
+
+    def get_groups(self):
+        """Renders page listing every group of similar patches."""
+        etag = responses.make_etag(library_tag(), template_version(),
+                                   self.path)
+        if self.not_modified(etag):
+            return
+        with library_lock.reading():
+            known_names = set(all_patches)
+        variables = {'devices': sorted(patch_groups.items()),
+                     'known_names': known_names}
+        content = self.render_template('groups.html', variables)
+        self.send_content(200, ('<html><head><title>Groups</title>' +
+                                content).encode('utf-8'),
+                          'text/html', etag)
+
+def render_stream(template, filename, variables):
+    """Yields the parts of a template as it is rendered.
+
+    Only the time spent rendering counts towards render_seconds, not the
+    time the caller spends compressing and sending each part.
+    """
+    stream = template.stream(variables)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    stream = iter(stream)
+    seconds = 0.0
+    try:
+        while True:
+            start = time.time()
+            part = next(stream, None)
+            seconds += time.time() - start
+            if part is None:
+                return
+            yield part
+    finally:
+        # Also reached if the client goes away mid-page.
+        metrics.render_seconds.observe(seconds, template=filename)
+
+def patch_group(patch):
+    """Returns the group holding patch for templates, or None.
+
+    The result holds the group's number, its central patch, and the
+    names of the other members.
+    """
+    location = patch_group_index.get(patch.content_hash())
+    if location is None:
+        return None
+    device, index = location
+    group = patch_groups[device][index]
+    return {'number': index + 1,
+            'device': device,
+            'medoid': group['medoid'],
+            'members': [name for name, content_hash, _ in group['members']
+                        if name != patch.name]}
+
+def load_groups(filename):
+    """Loads groups of similar patches saved by group_patches.py."""
+    global patch_groups
+    global patch_group_index
+    patch_groups = clustering.read_groups(filename)
+    patch_group_index = {}
+    for device, groups in patch_groups.items():
+        for index, group in enumerate(groups):
+            for _, content_hash, _ in group['members']:
+                patch_group_index[content_hash] = (device, index)
+    logger.info('Loaded %d groups from %s',
+                sum(len(groups) for groups in patch_groups.values()), filename)
+
+def request_route(path):
+    """Returns the name of the page or API serving path, for metrics."""
+    if path.startswith('/api/'):
+        return 'api'
+    elif path.startswith('/patch'):
+        return 'patch'
+    elif path == '/':
+        return 'root'
+    elif path == '/groups':
+        return 'groups'
+    elif path == '/metrics':
+        return 'metrics'
+    return 'not_found'
+
+def find_root_patches(query):
+    """Returns sorted list of patches selected by a root page query.
+
+    query is a dictionary from urlparse.parse_qs.  Caller must hold
+    library_lock for reading.
+    """
+    collections = query.get('collection', [])
+    devices = query.get('device', [])
+    sort_key = query.get('sort', ['name'])[0]
+    descending = query.get('order', ['asc'])[0] == 'desc'
+
+    filters = [(key, value) for key in query for value in query[key]
+               if key not in ROOT_QUERY_KEYS]
+    # Filters on parameters in the patch stores are answered from their
+    # columns; anything else is checked against each patch's details.
+    store_filters = [(key, value) for key, value in filters
+                     if any(store.knows(key)
+                            for store in patch_stores.values())]
+    other_filters = [(key, value) for key, value in filters
+                     if (key, value) not in store_filters]
+
+    patches = patch_store.find_patches(patch_stores, devices, collections,
+                                       store_filters)
+    if other_filters:
+        patch_list = [x.details() for x in patches]
+        for key, value in other_filters:
+            patch_list = try_filter(patch_list, key, value)
+        # Sounds may share a patch_name, so match the dictionaries kept.
+        kept = set(id(x) for x in patch_list)
+        patches = [p for p in patches if id(p.details()) in kept]
+    return patch_store.sort_patches(patch_stores, patches, sort_key,
+                                    descending)
+
+def query_int(query, key, default, minimum=None):
+    """Returns an integer query parameter, or default if missing or bad."""
+    try:
+        value = int(query.get(key, [default])[0])
+    except ValueError:
+        return default
+    if minimum is not None:
+        value = max(value, minimum)
+    return value
+
+def make_template_environment(cache_dir=None, auto_reload=False):
+    """Returns a Jinja environment for the templates directory.
+
+    If cache_dir is given, compiled templates are kept there so later
+    launches don't compile them again.  auto_reload checks template files
+    for changes on every render, which is only worth it while editing
+    templates.
+    """
+    bytecode_cache = None
+    if cache_dir:
+        bytecode_dir = os.path.join(cache_dir, 'templates')
+        if not os.path.isdir(bytecode_dir):
+            os.makedirs(bytecode_dir)
+        bytecode_cache = jinja.FileSystemBytecodeCache(bytecode_dir)
+    return jinja.Environment(loader=jinja.FileSystemLoader('templates'),
+                             bytecode_cache=bytecode_cache,
+                             auto_reload=auto_reload)
+
+# Jinja environment shared by all requests, so templates are compiled once.
+template_environment = make_template_environment()
+
+# Hash of the template sources, computed on first use.
+_template_version = None
+
+def template_version():
+    """Returns a hash of the template sources.
+
+    Page tags include it, so editing a template invalidates pages cached
+    by browsers.  With --dev the templates are hashed on every call.
+    """
+    global _template_version
+    if _template_version is None or template_environment.auto_reload:
+        sources = []
+        for name in sorted(template_environment.list_templates()):
+            source, _, _ = template_environment.loader.get_source(
+                template_environment, name)
+            sources.extend([name, source.encode('utf-8')])
+        _template_version = responses.make_etag(*sources)
+    return _template_version
+
+def library_tag():
+    """Returns a string that changes whenever the library does."""
+    return '%d.%d' % (LAUNCH_TIME, library_version)
+
+def find_similar_patches(patch, count):
+    """Returns list of (patch, score) for the count patches nearest patch."""
+    table = neighbour_tables.get(patch.device)
+    if table and count <= table.count:
+        with metrics.similarity_seconds.time(method='table'):
+            return table.similar(patch)[:count]
+    index = lsh_indexes.get(patch.device)
+    if index:
+        with metrics.similarity_seconds.time(method='lsh'):
+            return index.most_similar(patch, count)
+    with metrics.similarity_seconds.time(method='exact'):
+        return similarity_engines[patch.device].most_similar(patch, count)
+
+def add_patches(patches):
+    """Adds decoded patches to all_patches and the similarity indexes."""
+    global library_version
+    with library_lock.writing():
+        library_version += 1
+        for patch in patches:
+            add_patch(patch)
+
+def replace_patches(old_copies, new_patches):
+    """Removes old copies of patches and adds new_patches in one change.
+
+    old_copies is a list of (content hash, filepath) for the copies to
+    remove.
+    """
+    global library_version
+    with library_lock.writing():
+        library_version += 1
+        remove_copies(old_copies)
+        for patch in new_patches:
+            add_patch(patch)
+
+def remove_copies(copies):
+    """Removes copies of patches; caller must hold library_lock for writing.
+
+    A patch leaves the library with its last copy.  If the copy the patch
+    was decoded from goes but others remain, the patch moves to the
+    collection and file of the next copy.
+    """
+    removed = []
+    for content_hash, filepath in copies:
+        patch = unique_patches.get(content_hash)
+        if patch is None:
+            continue
+        patch.locations = [location for location in patch.locations
+                           if location[1] != filepath]
+        if not patch.locations:
+            del unique_patches[content_hash]
+            removed.append(patch)
+            continue
+        if patch.filepath == filepath:
+            patch.collection, patch.filepath = patch.locations[0]
+            patch.settings['filename'] = os.path.basename(patch.filepath)
+            patch.settings['source'] = os.path.basename(patch.filepath)
+        if patch.device in patch_stores:
+            patch_stores[patch.device].update_locations(patch)
+    remove_patches(removed)
+
+def remove_patches(patches):
+    """Removes patches; caller must hold library_lock for writing."""
+    by_device = {}
+    for patch in patches:
+        unname_patch(patch)
+        by_device.setdefault(patch.device, []).append(patch)
+
+    for device, device_patches in by_device.items():
+        if device in patch_stores:
+            patch_stores[device].remove_patches(device_patches)
+        # The index needs the engine's rows before they go.
+        if device in lsh_indexes:
+            lsh_indexes[device].remove(device_patches)
+        table = neighbour_tables.get(device)
+        if table:
+            table.remove(device_patches)
+        elif device in similarity_engines:
+            similarity_engines[device].remove(device_patches)
+
+def base_name(patch):
+    """Returns the name patch had in its file, before any renaming."""
+    suffix = '~' + patch.content_hash()[:NAME_HASH_LENGTH]
+    if patch.name.endswith(suffix):
+        return patch.name[:-len(suffix)]
+    return patch.name
+
+def name_patch(patch, content_hash):
+    """Adds patch to all_patches under a name no other sound has.
+
+    A sound whose name is taken is renamed name~<start of content hash>,
+    so both sounds can be shown and linked.  Caller must hold
+    library_lock for writing.
+    """
+    if patch.name in all_patches:
+        name_variants.setdefault(patch.name, []).append(patch)
+        patch.name = '%s~%s' % (patch.name, content_hash[:NAME_HASH_LENGTH])
+    all_patches[patch.name] = patch
+
+def unname_patch(patch):
+    """Removes patch from all_patches.
+
+    If it held a plain name shared with renamed sounds, the name leads to
+    the first of those from now on.  Caller must hold library_lock for
+    writing.
+    """
+    name = base_name(patch)
+    variants = name_variants.get(name, [])
+    if patch in variants:
+        variants.remove(patch)
+    for key in set([patch.name, name]):
+        if all_patches.get(key) is patch:
+            del all_patches[key]
+    if variants and name not in all_patches:
+        all_patches[name] = variants[0]
+    if not variants:
+        name_variants.pop(name, None)
+
+def add_patch(patch):
+    """Adds one patch; caller must hold library_lock for writing.
+
+    A copy of a patch already in the library is only recorded in that
+    patch's locations.
+    """
+    content_hash = patch.content_hash()
+    original = unique_patches.get(content_hash)
+    if original is not None:
+        original.locations.append((patch.collection, patch.filepath))
+        if original.device in patch_stores:
+            patch_stores[original.device].update_locations(original)
+        return
+    unique_patches[content_hash] = patch
+    patch.locations = [(patch.collection, patch.filepath)]
+
+    if patch.name in favorites:
+        patch.is_favorite = True
+        logger.debug('%s is favorite', patch.name)
+    name_patch(patch, content_hash)
+
+    # Indexes are built in one go once startup loading finishes; after
+    # that, keep them up to date one patch at a time.
+    if not patch_stores:
+        return
+    if patch.device in patch_stores:
+        patch_stores[patch.device].add(patch)
+    else:
+        patch_stores.update(patch_store.build_stores([patch]))
+    table = neighbour_tables.get(patch.device)
+    if table:
+        table.add(patch)
+    elif patch.device in similarity_engines:
+        similarity_engines[patch.device].add(patch)
+    else:
+        similarity_engines[patch.device] = similarity.SimilarityEngine(
+            patch.definitions, [patch])
+    if patch.device in lsh_indexes:
+        lsh_indexes[patch.device].add(patch)
 
 UNKNOWN = 0
 REFACE_DX = 1
 VIRUS_TI = 2        
 
-def decode_patch(filepath, manufacturer):
+def decode_patch(filepath, manufacturer, messages=None):
     if manufacturer == REFACE_DX:
-        return refacedx_patch.read_patches(filepath)
+        return refacedx_patch.read_patches(filepath, messages)
     elif manufacturer == VIRUS_TI:
-        return access_patch.read_patches(filepath)
+        return access_patch.read_patches(filepath, messages)
 
 def decode_patches(filepath):
     """Returns patches found."""
     if filepath.endswith('syx'):
-        messages = mido.read_syx_file(filepath)
-        if (messages) == 0:
+        messages = sysex_reader.read_syx_file(filepath)
+        if not messages:
             return []
 
-        manufacturer = read_manufacturer_from_bytes(messages[0].bin())
-        return decode_patch(filepath, manufacturer)
+        manufacturer = read_manufacturer_from_bytes(messages[0])
+        return decode_patch(filepath, manufacturer, messages)
 
     elif filepath.endswith('mid'):
-        patch_file = mido.MidiFile(filepath)
-        for i, track in enumerate(patch_file.tracks):
-            for msg in track:
-                bytes = msg.bin()
-                bytes = msg.bin()
-                if len(bytes) == 524:
-                    manufacturer = read_manufacturer_from_bytes(bytes)
-                    return decode_patch(filepath, manufacturer)
+        # One pass over the file: the first patch-sized message decides
+        # the manufacturer, and is decoded along with the rest.
+        messages = sysex_reader.read_midi_sysex(
+            filepath, access_patch.SINGLE_DUMP_LENGTH)
+        first = next(messages, None)
+        if first is None:
+            return []
+        manufacturer = read_manufacturer_from_bytes(first)
+        return decode_patch(filepath, manufacturer,
+                            itertools.chain([first], messages))
     return []
 
+def find_patch_files(patch_dirs, include=None, exclude=None):
+    """Yields patch files anywhere under the directories.
+
+    include and exclude are lists of file name patterns, as for
+    discovery.find_files.
+    """
+    files = discovery.find_files(patch_dirs, include, exclude,
+                                 sniff_patch_file)
+    while True:
+        # Only time spent walking counts, not decoding between files.
+        start = time.time()
+        filepath = next(files, None)
+        metrics.discovery_seconds.inc(time.time() - start)
+        if filepath is None:
+            return
+        metrics.files_found.inc()
+        yield filepath
+
+def sniff_patch_file(head):
+    """Returns False if a file's first bytes show it isn't a patch file.
+
+    Raw sysex must come from a known synthesizer.  MIDI files and sysex
+    written as hex text are checked when decoded.
+    """
+    head = bytearray(head)
+    if head.startswith('MThd'):
+        return True
+    if head.startswith('\xf0'):
+        return (len(head) >= 5 and
+                read_manufacturer_from_bytes(head) != UNKNOWN)
+    return head.strip().lower().startswith('f0')
+
+def refresh_files(added, changed, removed, cache=None):
+    """Updates the library for patch files changed since they were loaded.
+
+    Only the added and changed files are decoded.  Decoding happens before
+    taking library_lock, so requests are only held up while the indexes
+    are updated.
+    """
+    decoded = dict(load_files(added + changed, cache))
+    if cache:
+        for filepath in removed:
+            cache.remove(filepath)
+        cache.commit()
+
+    old_copies = []
+    for filepath in changed + removed:
+        old_copies.extend((content_hash, filepath)
+                          for content_hash in file_patches.pop(filepath, []))
+    new_patches = []
+    for filepath in added + changed:
+        patches = decoded.get(filepath)
+        if patches:
+            file_patches[filepath] = [p.content_hash() for p in patches]
+            new_patches.extend(patches)
+    replace_patches(old_copies, new_patches)
+    logger.info('Library updated: %d files added, %d changed, %d removed',
+                len(added), len(changed), len(removed))
+
+def watch_files(patch_dirs, cache=None, interval=watcher.POLL_INTERVAL,
+                include=None, exclude=None):
+    """Starts a thread keeping the library up to date with patch_dirs."""
+    file_watcher = watcher.make_watcher(
+        patch_dirs,
+        lambda: list(find_patch_files(patch_dirs, include, exclude)),
+        interval)
+    logger.info('Watching %s with %s', patch_dirs,
+                type(file_watcher).__name__)
+    thread = threading.Thread(
+        target=file_watcher.watch,
+        args=(lambda *changes: refresh_files(*changes, cache=cache),),
+        name='file-watcher')
+    thread.daemon = True
+    thread.start()
+
+def decode_file(filepath):
+    """Returns (patches, error) for one patch file.
+
+    error describes why decoding failed, or is None.
+    """
+    try:
+        return decode_patches(filepath) or [], None
+    except Exception as e:
+        return None, '%s: %s' % (type(e).__name__, e)
+
+def decode_file_records(filepath):
+    """Version of decode_file for worker processes.
+
+    Patches are returned as patch_cache records, which are much cheaper to
+    send back to the parent process.  Also returns the seconds spent
+    decoding, since metrics recorded in the worker are lost.
+    """
+    start = time.time()
+    patches, error = decode_file(filepath)
+    seconds = time.time() - start
+    if error:
+        return None, error, seconds
+    return [patch_cache.to_record(p) for p in patches], None, seconds
+
+def load_files(files, cache=None, jobs=1):
+    """Yields (filepath, patches) for each file, in the order of files.
+
+    files can be any iterable, such as a generator still walking the
+    patch directories; decoding starts with the first file found.  Uses
+    the patch cache when possible.  With jobs > 1, files missing from the
+    cache are decoded by a pool of processes, working up to LOAD_AHEAD
+    files each beyond the one being returned.  Files that can't be
+    decoded are reported and skipped.
+    """
+    pool = None
+    ahead = 0
+    if jobs > 1:
+        ahead = jobs * LOAD_AHEAD
+    # (filepath, cached patches, pool result) for files found but not yet
+    # returned, in order.
+    waiting = collections.deque()
+
+    def finish(filepath, patches, result):
+        """Returns the patches for a file, or None if decoding failed."""
+        logger.debug('Looking at %s', filepath)
+        if patches is not None:
+            metrics.cache_hits.inc()
+            metrics.patches_decoded.inc(len(patches))
+            return patches
+        if result is None:
+            start = time.time()
+            patches, error = decode_file(filepath)
+            seconds = time.time() - start
+        else:
+            patches, error, seconds = result.get()
+            if not error:
+                patches = [patch_cache.from_record(r) for r in patches]
+        metrics.decode_seconds.observe(seconds)
+        if error:
+            metrics.decode_failures.inc()
+            logger.warning('Failed to decode %s: %s', filepath, error)
+            return None
+        metrics.patches_decoded.inc(len(patches))
+        if cache:
+            cache.put(filepath, patches)
+        return patches
+
+    failures = 0
+    try:
+        # None marks the end of files, when every waiting file is finished.
+        for filepath in itertools.chain(files, [None]):
+            if filepath is not None:
+                patches = None
+                if cache:
+                    patches = cache.get(filepath)
+                result = None
+                if patches is None and jobs > 1:
+                    if pool is None:
+                        pool = multiprocessing.Pool(jobs)
+                    result = pool.apply_async(decode_file_records,
+                                              (filepath,))
+                waiting.append((filepath, patches, result))
+            while waiting and (filepath is None or len(waiting) > ahead):
+                entry = waiting.popleft()
+                patches = finish(*entry)
+                if patches is None:
+                    failures += 1
+                    continue
+                yield entry[0], patches
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    if failures:
+        logger.warning('%d files could not be decoded', failures)
+
 def read_manufacturer_from_bytes(bytes):
     if (bytes[0] == 0xf0 and
         bytes[1] == 0x43 and
@@ -221,11 +1006,148 @@ def read_manufacturer_from_bytes(bytes):
     return UNKNOWN
             
 
+def parse_arguments(argv):
+    """Returns parsed command line options."""
+    parser = argparse.ArgumentParser(
+        description='Web server for comparing synthesizer patches.')
+    parser.add_argument('patch_dirs', nargs='*', metavar='directory',
+                        help='directory with patches')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of processes decoding patch files')
+    parser.add_argument('--compact', action='store_true',
+                        help='decode patch parameters on demand to save '
+                        'memory with large libraries')
+    parser.add_argument('--lazy', action='store_true',
+                        help='decode each patch\'s parameters the first '
+                        'time a page needs them, rather than at startup')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory for the decoded patch cache '
+                        '(default: %s)' % patch_cache.default_cache_dir())
+    parser.add_argument('--no-cache', action='store_true',
+                        help='decode every patch file, ignoring the cache')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='number of threads answering web requests')
+    parser.add_argument('--dev', action='store_true',
+                        help='reload templates when they change')
+    parser.add_argument('--precompute-similar', action='store_true',
+                        help='find similar patches for every patch at '
+                        'startup rather than on each page view')
+    parser.add_argument('--similar-workers', type=int, default=None,
+                        help='threads used for --precompute-similar '
+                        '(default: one per CPU)')
+    parser.add_argument('--approximate-above', type=int, default=None,
+                        metavar='N',
+                        help='find similar patches approximately for '
+                        'devices with more than N patches')
+    parser.add_argument('--approximate-tables', type=int,
+                        default=similarity.DEFAULT_LSH_TABLES, metavar='N',
+                        help='hash tables searched by approximate search; '
+                        'more find more of the most similar patches, but '
+                        'take longer')
+    parser.add_argument('--groups', default=None, metavar='FILE',
+                        help='groups of similar patches saved by '
+                        'group_patches.py (default: %s in the cache '
+                        'directory, if present)' % clustering.GROUPS_FILENAME)
+    parser.add_argument('--include', action='append', metavar='PATTERN',
+                        help='only load files whose names match PATTERN '
+                        '(default: %s)' % ' '.join(discovery.DEFAULT_INCLUDE))
+    parser.add_argument('--exclude', action='append', metavar='PATTERN',
+                        default=[],
+                        help='skip files and directories whose names '
+                        'match PATTERN')
+    parser.add_argument('--save-snapshot', default=None, metavar='FILE',
+                        help='after loading the patch directories, save '
+                        'the library to FILE for --snapshot')
+    parser.add_argument('--snapshot', default=None, metavar='FILE',
+                        help='serve the library saved in FILE by '
+                        '--save-snapshot, rather than loading the patch '
+                        'directories')
+    parser.add_argument('--watch', action='store_true',
+                        help='pick up patch files added, changed or '
+                        'removed while running')
+    parser.add_argument('--watch-interval', type=float,
+                        default=watcher.POLL_INTERVAL,
+                        help='seconds between checks for changed files '
+                        'where inotify is unavailable')
+    parser.add_argument('--log-level', default='info',
+                        choices=LOG_LEVELS,
+                        help='least important messages to log')
+    return parser.parse_args(argv)
+
+def configure_logging(level):
+    """Sends log messages at level or above to stderr."""
+    logging.basicConfig(level=getattr(logging, level.upper()),
+                        format='%(asctime)s %(levelname)s %(name)s: '
+                        '%(message)s')
+
+def load_library(patch_dirs, cache, args):
+    """Loads every patch file in patch_dirs, and builds the indexes."""
+    global patch_stores
+    global similarity_engines
+
+    files = find_patch_files(patch_dirs, args.include, args.exclude)
+    for file_path, patches in load_files(files, cache, args.jobs):
+        if not patches:
+            logger.info('No patches in file %s', file_path)
+            continue
+
+        file_patches[file_path] = [p.content_hash() for p in patches]
+        add_patches(patches)
+
+    if cache:
+        cache.commit()
+
+    if not file_patches:
+        logger.error('No patches found in %s', patch_dirs)
+        sys.exit(1)
+    logger.info('%d patches, %d unique',
+                sum(len(hashes) for hashes in file_patches.values()),
+                len(unique_patches))
+
+    patch_stores = patch_store.build_stores(unique_patches.values())
+    similarity_engines = similarity.build_engines(patch_stores)
+
+def load_snapshot(filename, watch=False):
+    """Serves the library saved by --save-snapshot.
+
+    Patches are only built when requests need them.  file_patches, only
+    needed to watch for changed files, is filled in if watch is true.
+    """
+    global all_patches
+    global unique_patches
+    global file_patches
+    global patch_stores
+    global similarity_engines
+
+    try:
+        snapshot = library_snapshot.Snapshot(filename)
+    except (IOError, ValueError, library_snapshot.SnapshotError) as e:
+        logger.error('Unable to read snapshot %s: %s', filename, e)
+        sys.exit(1)
+    all_patches = snapshot.named_patches()
+    unique_patches = snapshot.unique_patches()
+    if watch:
+        file_patches = snapshot.file_patches()
+        # Only renamed sounds have a ~ in their names.
+        for name in [name for name in all_patches if '~' in name]:
+            p = all_patches[name]
+            if p.name == name and base_name(p) != name:
+                name_variants.setdefault(base_name(p), []).append(p)
+    patch_stores = snapshot.stores()
+    similarity_engines = similarity.build_engines(patch_stores)
+    logger.info('%d patches, %d unique, from %s', snapshot.copies(),
+                len(snapshot), filename)
+
 def run(server_class=BaseHTTPServer.HTTPServer,
         handler_class=PatchCompareHandler):
-    global all_patches
+    global neighbour_tables
+    global lsh_indexes
+    global template_environment
+
+    args = parse_arguments(sys.argv[1:])
+    configure_logging(args.log_level)
 
-    if len(sys.argv) == 1:
+    if not args.patch_dirs:
         patch_dirs = [
             # Mostly Reface.
             '/Users/bowdidge/Desktop/Circuit',
@@ -236,37 +1158,65 @@ def run(server_class=BaseHTTPServer.HTTPServer,
             '/Library/Application Support/Access Music/Virus TI/Patches',
             ]
     else:
-        patch_dirs = sys.argv[1:]
+        patch_dirs = args.patch_dirs
 
-    files = []
+    patch.compact_settings = args.compact
+    patch.lazy_settings = args.lazy
 
-    for match in ['*.syx', '*/*.syx', '*.mid', '*/*.mid']:
-        for patch_dir in patch_dirs:
-            pattern = '%s/%s' % (patch_dir, match)
-            files.extend(glob.glob(pattern))
+    cache = None
+    if not args.no_cache:
+        cache = patch_cache.PatchCache(args.cache_dir)
 
-    if not files:
-        print 'No patches found in %s' % patch_dirs
-        sys.exit(1)
+    template_cache_dir = None
+    if not args.no_cache:
+        template_cache_dir = args.cache_dir or patch_cache.default_cache_dir()
+    template_environment = make_template_environment(template_cache_dir,
+                                                     args.dev)
+    for template in TEMPLATES:
+        template_environment.get_template(template)
+
+    start = time.time()
+    if args.snapshot:
+        load_snapshot(args.snapshot, args.watch)
+    else:
+        load_library(patch_dirs, cache, args)
+    metrics.load_seconds.set(time.time() - start)
+    if args.save_snapshot:
+        library_snapshot.write_snapshot(args.save_snapshot, unique_patches,
+                                        all_patches, patch_stores,
+                                        similarity_engines)
+        logger.info('Library saved to %s', args.save_snapshot)
 
-    for file_path in files:
-        print 'Looking at %s' % file_path
-        filename = os.path.basename(file_path)
-        patches = decode_patches(file_path)
+    if args.approximate_above is not None:
+        lsh_indexes = similarity.build_lsh_indexes(
+            similarity_engines, args.approximate_above,
+            args.approximate_tables)
+    if args.precompute_similar:
+        logger.info('Precomputing similar patches')
+        neighbour_tables = similarity.build_neighbour_tables(
+            similarity_engines, SIMILAR_COUNT, args.similar_workers)
 
-        if not patches:
-            print 'No patches in file %s' % file_path
-            continue
+    groups_file = args.groups
+    if not groups_file and not args.no_cache:
+        groups_file = os.path.join(
+            args.cache_dir or patch_cache.default_cache_dir(),
+            clustering.GROUPS_FILENAME)
+        if not os.path.exists(groups_file):
+            groups_file = None
+    if groups_file:
+        load_groups(groups_file)
 
-        for patch in patches:
-            if patch.name in favorites:
-                patch.is_favorite = True
-                print '%s is favorite' % patch.name
-            all_patches[patch.name] = patch
+    if args.watch:
+        watch_files(patch_dirs, cache, args.watch_interval, args.include,
+                    args.exclude)
 
     server_address = ('', 8080)
-    httpd = server_class(server_address, handler_class)
-    print 'Serving at %s' % str(server_address)
+    if args.threads > 1:
+        httpd = concurrency.ThreadPoolHTTPServer(server_address,
+                                                 handler_class, args.threads)
+    else:
+        httpd = server_class(server_address, handler_class)
+    logger.info('Serving at %s', str(server_address))
     httpd.serve_forever()
 
 favorites = ['ColoColoTU', 'Nylon   BC', 'Banco TU', 'AandreasM@',
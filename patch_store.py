@@ -0,0 +1,387 @@
+#!/usr/bin/env python2.7
+#
+# Columnar storage of the decoded parameters for a whole library.
+#
+# Patches are individual objects, so asking "which Virus patches have a
+# filter cutoff above 100?" means visiting every one of them.  A
+# PatchStore keeps the raw patch bytes for every patch of one device in a
+# single NumPy matrix, and decodes one column per parameter on demand.
+# Root page filters, sorting and similarity searches then work on whole
+# columns at once.
+#
+# Robert Bowdidge, December 2019.
+
+import numpy
+
+import patch
+
+# Initial number of rows allocated in a store.
+INITIAL_CAPACITY = 64
+
+
+class PatchStore(object):
+    """Parameters for every patch of a single device, stored by column.
+
+    Rows are in the order patches were added.  Patches keep their own
+    settings; the store refers to them by row.
+    """
+
+    def __init__(self, definitions, cc_offset, select_styles):
+        self.definitions = definitions
+        self.plan = patch.parse_plan(definitions, cc_offset)
+        self.select_styles = select_styles or {}
+
+        # Patches in row order.
+        self.patches = []
+        # Map from patch to its row.
+        self.rows = {}
+        # Map from collection name to list of rows of its patches.
+        self.collection_rows = {}
+
+        # Raw bytes of each patch's main sysex message, one row per patch.
+        # Allocated with spare capacity so adding patches is cheap.
+        self.width = max(end for _, end, _ in self.plan.index.values())
+        self.raw = numpy.zeros((INITIAL_CAPACITY, self.width),
+                               dtype=numpy.uint8)
+
+        # Map from settings key to decoded column.  Filled on demand, and
+        # thrown away when patches are added.
+        self.columns = {}
+        # Map from settings key to dictionary mapping each value to an array
+        # of the rows holding it.  Filled on demand like columns.
+        self.value_indexes = {}
+        # Map from settings key to (sorted values, rows in that order), for
+        # range queries.  Filled on demand like columns.
+        self.sorted_indexes = {}
+        # Map from tuple of settings keys to the matrix of those columns.
+        # Filled on demand like columns.
+        self.matrices = {}
+
+    def __len__(self):
+        return len(self.patches)
+
+    def add(self, p):
+        """Adds a patch as a new row."""
+        self.add_patches([p])
+
+    def add_patches(self, patches):
+        """Adds patches as new rows."""
+        patches = list(patches)
+        first = len(self.patches)
+        needed = first + len(patches)
+        if needed > len(self.raw):
+            capacity = max(needed, 2 * len(self.raw))
+            raw = numpy.zeros((capacity, self.width), dtype=numpy.uint8)
+            raw[:first] = self.raw[:first]
+            self.raw = raw
+
+        for i, p in enumerate(patches):
+            sysex = bytearray(main_sysex(p))[:self.width]
+            self.raw[first + i, :len(sysex)] = numpy.frombuffer(
+                bytes(sysex), dtype=numpy.uint8)
+            self.rows[p] = first + i
+            self.patches.append(p)
+            for collection in patch_collections(p):
+                self.collection_rows.setdefault(collection, []).append(
+                    first + i)
+        self.columns = {}
+        self.value_indexes = {}
+        self.sorted_indexes = {}
+        self.matrices = {}
+
+    def remove_patches(self, patches):
+        """Removes the rows of patches.  Later rows move up to fill gaps."""
+        removed = sorted(set(self.rows[p] for p in patches if p in self.rows))
+        if not removed:
+            return
+        self.raw = numpy.delete(self.raw, removed, axis=0)
+        self.patches, self.rows = remove_rows(self.patches, self.rows,
+                                              patches)
+        # Renumber collection rows rather than asking each patch, which
+        # would build every patch of a snapshot.
+        collection_rows = {}
+        for collection, rows in self.collection_rows.items():
+            rows = numpy.array(rows, dtype=int)
+            rows = rows[~numpy.in1d(rows, removed)]
+            if len(rows):
+                collection_rows[collection] = (
+                    rows - numpy.searchsorted(removed, rows)).tolist()
+        self.collection_rows = collection_rows
+        self.columns = {}
+        self.value_indexes = {}
+        self.sorted_indexes = {}
+        self.matrices = {}
+
+    def update_locations(self, p):
+        """Brings collection rows up to date after p.locations changes."""
+        row = self.rows[p]
+        for rows in self.collection_rows.values():
+            if row in rows:
+                rows.remove(row)
+        for collection in patch_collections(p):
+            self.collection_rows.setdefault(collection, []).append(row)
+
+    def knows(self, key):
+        """Returns True if key names a parameter held in the store."""
+        return key in self.plan.index
+
+    def column(self, key):
+        """Returns array of the settings value for key for every row.
+
+        Values match those Patch.parse puts in settings.  String
+        parameters are returned as an array of Python strings.
+        """
+        column = self.columns.get(key)
+        if column is not None:
+            return column
+        start, end, type = self.plan.index[key]
+        if type == patch.STRING_TYPE:
+            column = numpy.array(
+                [row.tostring().strip()
+                 for row in self.raw[:len(self.patches), start:end]],
+                dtype=object)
+            self.columns[key] = column
+            return column
+        raw = self.raw[:len(self.patches), start].astype(numpy.int16)
+        if type == patch.PLUS_MINUS_TYPE:
+            column = raw - 64
+        elif type == patch.PLUS_MINUS_PERCENT_TYPE:
+            column = 100 * (raw - 64) // 64
+        elif type == patch.PERCENT_TYPE:
+            column = 100 * raw // 124
+        else:
+            column = raw
+        self.columns[key] = column
+        return column
+
+    def matrix(self, keys):
+        """Returns a rows x keys int64 matrix of the given columns.
+
+        Callers must not change the returned matrix.
+        """
+        matrix = self.matrices.get(tuple(keys))
+        if matrix is not None:
+            return matrix
+        if not keys:
+            matrix = numpy.zeros((len(self.patches), 0), dtype=numpy.int64)
+        else:
+            matrix = numpy.column_stack(
+                [self.column(key) for key in keys]).astype(numpy.int64)
+        self.matrices[tuple(keys)] = matrix
+        return matrix
+
+    def value_index(self, key):
+        """Returns dictionary mapping each value of key to array of rows."""
+        index = self.value_indexes.get(key)
+        if index is not None:
+            return index
+        values = self.column(key)
+        order = numpy.argsort(values, kind='mergesort')
+        index = {}
+        if len(order):
+            sorted_values = values[order]
+            starts = numpy.flatnonzero(sorted_values[1:] != sorted_values[:-1])
+            bounds = [0] + list(starts + 1) + [len(order)]
+            for begin, end in zip(bounds[:-1], bounds[1:]):
+                index[sorted_values[begin]] = numpy.sort(order[begin:end])
+        self.value_indexes[key] = index
+        return index
+
+    def sorted_index(self, key):
+        """Returns (sorted values of key, rows in the same order)."""
+        index = self.sorted_indexes.get(key)
+        if index is None:
+            values = self.column(key)
+            order = numpy.argsort(values, kind='mergesort')
+            index = (values[order], order)
+            self.sorted_indexes[key] = index
+        return index
+
+    def all_rows(self):
+        return numpy.arange(len(self.patches))
+
+    def collection_matches(self, collections):
+        """Returns sorted array of rows in any of the collections."""
+        rows = [self.collection_rows.get(c, []) for c in collections]
+        return numpy.unique(numpy.concatenate([[]] + rows).astype(int))
+
+    def matches(self, key, query_value):
+        """Returns sorted array of rows matching a root page query.
+
+        Follows the rules of patch_compare.try_filter: query_value is
+        either a value to match, compared against both the displayed and
+        raw value, or a bound such as ge15 or le15.  Range queries on
+        SELECT_TYPE and ON_OFF_TYPE parameters compare the raw value.
+        """
+        if 'ge' not in query_value and 'le' not in query_value:
+            rows = []
+            if key in self.plan.index:
+                rows.append(self.matches_display(key, query_value))
+            if key + '_numeric' in self.plan.index:
+                rows.append(self.matches_number(key + '_numeric',
+                                                query_value))
+            return numpy.unique(numpy.concatenate([[]] + rows).astype(int))
+
+        greater_equal = 'ge' in query_value
+        try:
+            base_value = int(query_value.replace('ge', '').replace('le', ''))
+        except ValueError:
+            return self.all_rows()
+        if key not in self.plan.index:
+            # Patches without the parameter aren't filtered out.
+            return self.all_rows()
+        if self.column(key).dtype == object:
+            return numpy.array(
+                [row for row, v in enumerate(self.column(key))
+                 if (greater_equal and v >= base_value) or
+                 (not greater_equal and v <= base_value)], dtype=int)
+        values, order = self.sorted_index(key)
+        if greater_equal:
+            rows = order[numpy.searchsorted(values, base_value, 'left'):]
+        else:
+            rows = order[:numpy.searchsorted(values, base_value, 'right')]
+        return numpy.sort(rows)
+
+    def matches_number(self, key, query_value):
+        """Returns sorted array of rows whose value for key is query_value."""
+        try:
+            number = int(query_value)
+        except ValueError:
+            number = None
+        if number is None or str(number) != query_value:
+            return numpy.array([], dtype=int)
+        return self.value_index(key).get(number, numpy.array([], dtype=int))
+
+    def matches_display(self, key, query_value):
+        """Returns sorted array of rows where key is shown as query_value."""
+        _, _, type = self.plan.index[key]
+        index = self.value_index(key)
+        if type == patch.STRING_TYPE:
+            return index.get(query_value, numpy.array([], dtype=int))
+        if type == patch.ON_OFF_TYPE:
+            if query_value == 'off':
+                codes = [0]
+            elif query_value == 'on':
+                codes = [code for code in index if code != 0]
+            else:
+                codes = []
+        elif type == patch.SELECT_TYPE:
+            labels = self.select_styles.get(key, {})
+            codes = [code for code in index
+                     if select_display(labels, int(code)) == query_value]
+        else:
+            return self.matches_number(key, query_value)
+        return numpy.unique(numpy.concatenate(
+            [[]] + [index.get(code, []) for code in codes]).astype(int))
+
+
+def select_display(labels, value):
+    """Returns the text Patch.select_label shows for a SELECT_TYPE value."""
+    if value not in labels:
+        return str(value)
+    return '%s (%d)' % (labels[value], value)
+
+
+def patch_collections(p):
+    """Returns set of collections holding a copy of a patch."""
+    return set([p.collection] +
+               [collection for collection, _ in p.locations])
+
+
+def main_sysex(p):
+    """Returns the sysex message holding a patch's main parameters."""
+    for group_key, sysex in p.messages:
+        if not group_key:
+            return sysex
+    return p.sysex
+
+
+def find_patches(stores, devices, collections, filters):
+    """Returns list of patches matching a root page query.
+
+    devices and collections are lists of names to keep; empty lists keep
+    everything.  filters is a list of (key, query_value) pairs, as for
+    PatchStore.matches.  The rows matching each condition come from the
+    stores' indexes, and are intersected smallest first.
+    """
+    result = []
+    for device, store in stores.items():
+        if devices and device not in devices:
+            continue
+        row_sets = []
+        if collections:
+            row_sets.append(store.collection_matches(collections))
+        for key, query_value in filters:
+            row_sets.append(store.matches(key, query_value))
+        if not row_sets:
+            rows = store.all_rows()
+        else:
+            row_sets.sort(key=len)
+            rows = row_sets[0]
+            for other in row_sets[1:]:
+                if not len(rows):
+                    break
+                rows = numpy.intersect1d(rows, other, assume_unique=True)
+        result.extend(store.patches[i] for i in rows)
+    return result
+
+
+def sort_patches(stores, patches, key, descending=False):
+    """Returns patches sorted by the value of key.
+
+    key is a parameter in the stores, or one of 'collection', 'device' or
+    'name'.  Patches without the parameter go last.  Ties are broken by
+    patch name.
+    """
+    if key in ['collection', 'device', 'name']:
+        values = dict((p, getattr(p, key)) for p in patches)
+    else:
+        values = {}
+        for device, store in stores.items():
+            if store.knows(key):
+                column = store.column(key)
+                rows = store.rows
+                values.update((p, column[rows[p]])
+                              for p in patches if p in rows)
+    present = sorted([p for p in patches if p in values],
+                     key=lambda p: (values[p], p.name), reverse=descending)
+    missing = sorted([p for p in patches if p not in values],
+                     key=lambda p: p.name)
+    return present + missing
+
+
+def remove_rows(patches, rows, removed):
+    """Returns (patches, rows) without the patches in removed.
+
+    patches is a list of patches in row order, and rows maps each patch
+    to its row; later rows move up to fill gaps.  Containers for a
+    snapshot's rows are changed in place, so patches that haven't been
+    built from the snapshot yet aren't built now.
+    """
+    if isinstance(rows, dict):
+        gone = set(removed)
+        patches = [p for p in patches if p not in gone]
+        return patches, dict((p, i) for i, p in enumerate(patches))
+    # Last row first, so the rows still to go keep their numbers.
+    for row in sorted(set(rows[p] for p in removed if p in rows),
+                      reverse=True):
+        del patches[row]
+    for p in removed:
+        if p in rows:
+            del rows[p]
+    return patches, rows
+
+
+def build_stores(patches):
+    """Returns dictionary mapping device name to a PatchStore."""
+    by_device = {}
+    for p in patches:
+        by_device.setdefault(p.device, []).append(p)
+    stores = {}
+    for device, device_patches in by_device.items():
+        first = device_patches[0]
+        store = PatchStore(first.definitions, first.cc_offset,
+                           first.select_styles)
+        store.add_patches(device_patches)
+        stores[device] = store
+    return stores
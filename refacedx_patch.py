@@ -6,17 +6,20 @@
 #
 # Robert Bowdidge, December 2019.
 
+import logging
 import math
-import mido
 import os
 import sys
 
 import patch
+import sysex_reader
 
 STRING_TYPE = patch.STRING_TYPE
 POSITIVE_TYPE = patch.POSITIVE_TYPE
 SELECT_TYPE = patch.SELECT_TYPE
 PLUS_MINUS_TYPE = patch.PLUS_MINUS_TYPE
+
+logger = logging.getLogger(__name__)
 #LFO Speed                                                                      
 debug = False
 
@@ -160,6 +163,7 @@ refacedx_voice_definitions = [
 ]
 
 class RefaceDXPatch(patch.Patch):
+    __slots__ = ()
 
     def __init__(self, filepath):
         super(RefaceDXPatch, self).__init__(filepath, cc_offset=6)
@@ -175,6 +179,11 @@ class RefaceDXPatch(patch.Patch):
     def compare(self, patch):
         return 0.0
 
+    def group_definitions(self, group_key):
+        if group_key:
+            return refacedx_voice_definitions
+        return refacedx_definitions
+
     def asDict(self):
         result = super(RefaceDXPatch, self).asDict()
         # Insert graphs here.
@@ -201,23 +210,25 @@ class RefaceDXPatch(patch.Patch):
                                                                     
         return result
 
-def read_patches(filepath):
+def read_patches(filepath, messages=None):
     """Read a DX patch at the given file path.
     
     Reface DX patches have one sysex for the main patch, and separate sysex
     messages for each voice.  We'll assume everything in the same sysex
     file is for a single patch.
+
+    messages optionally holds the sysex messages already read from the
+    file, so the file isn't read again.
     """
     patches = []
     current_patch = None
-    messages = mido.read_syx_file(filepath)
-    for message in messages:
-        bytes = message.bin()
+    if messages is None:
+        messages = sysex_reader.read_syx_file(filepath)
+    for bytes in messages:
         if (bytes[0] != 0xf0 or bytes[1] != 0x43 or bytes[2] != 0x0 or
             bytes[3] != 0x7f or bytes[4] != 0x1c):
-            print 'Not reface DX patch.'
-            print '%x %x %x %x %x' % (bytes[0], bytes[1], bytes[2],
-                                      bytes[3], bytes[4])
+            logger.warning('Not reface DX patch: %x %x %x %x %x', bytes[0],
+                           bytes[1], bytes[2], bytes[3], bytes[4])
 
         if len(bytes) == 13:
             # header
@@ -228,18 +239,18 @@ def read_patches(filepath):
                 patches.append(current_patch)
             current_patch = RefaceDXPatch(filepath)
             current_patch.collection = os.path.basename(os.path.dirname(filepath))
-            current_patch.parse(message.bin())
+            current_patch.parse(bytes)
             current_patch.name = current_patch.settings['patch_name']
             voice_number = 1
         elif len(bytes) == 41:
             # Voice
-            current_patch.parse(message.bin(),
+            current_patch.parse(bytes,
                                 definitions=refacedx_voice_definitions,
                                 group_key='voice_%d' % voice_number)
             voice_number += 1
                                 
         else:
-            print 'Unknown reface dx message in %s' % filepath
+            logger.warning('Unknown reface dx message in %s', filepath)
     if current_patch:
         patches.append(current_patch)
     return patches
@@ -0,0 +1,105 @@
+#!/usr/bin/env python2.7
+#
+# Helpers for cheap repeat responses: entity tags and compression.
+#
+# Patch pages are large (inline SVGs, hex dumps) and rarely change.  Each
+# response is tagged with a hash of everything it was built from, so a
+# browser revisiting a page gets a bodiless 304.  Bodies that are sent are
+# compressed when the client allows it, and the tag names the compression,
+# since a strong tag stands for one exact sequence of bytes.
+#
+# Robert Bowdidge, December 2019.
+
+import hashlib
+import zlib
+
+# Bodies smaller than this aren't worth compressing.
+MIN_COMPRESS_SIZE = 512
+
+# zlib compression level; higher levels cost much more time for little
+# gain on HTML.
+COMPRESS_LEVEL = 6
+
+# Content encodings we can produce, best first.
+ENCODINGS = ['gzip', 'deflate']
+
+# Browsers may keep pages, but must check the tag before reusing them: a
+# patch page lists similar patches, which change as the library grows.
+CACHE_CONTROL = 'no-cache'
+
+
+def make_etag(*parts):
+    """Returns a strong entity tag for a response built from parts.
+
+    parts are strings (or buffers) covering everything the response
+    depends on.
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(len(part)))
+        digest.update(':')
+        digest.update(part)
+    return '"%s"' % digest.hexdigest()
+
+
+def encoded_etag(etag, encoding):
+    """Returns the tag for a body compressed with encoding.
+
+    etag is from make_etag.  Uncompressed bodies keep etag; compressed
+    ones get a tag such as "<hash>-gzip".
+    """
+    if not etag or not encoding:
+        return etag
+    return '%s-%s"' % (etag[:-1], encoding)
+
+
+def etag_matches(if_none_match, etag):
+    """Returns True if an If-None-Match header value covers etag."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags
+
+
+def negotiate_encoding(accept_encoding):
+    """Returns the encoding to use for an Accept-Encoding header value.
+
+    Returns 'gzip', 'deflate', or None for an uncompressed body.
+    """
+    qualities = {}
+    for part in (accept_encoding or '').split(','):
+        fields = part.split(';')
+        name = fields[0].strip().lower()
+        quality = 1.0
+        for field in fields[1:]:
+            field = field.strip()
+            if field.startswith('q='):
+                try:
+                    quality = float(field[2:])
+                except ValueError:
+                    quality = 0.0
+        if name:
+            qualities[name] = quality
+    best = None
+    best_quality = 0.0
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best = encoding
+            best_quality = quality
+    return best
+
+
+def compressor(encoding):
+    """Returns a zlib compression object producing encoding."""
+    if encoding == 'gzip':
+        # Adding 16 to the window size makes zlib write a gzip header.
+        return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                                16 + zlib.MAX_WBITS)
+    return zlib.compressobj(COMPRESS_LEVEL)
+
+
+def compress(data, encoding):
+    """Returns data compressed with encoding."""
+    c = compressor(encoding)
+    return c.compress(data) + c.flush()
@@ -0,0 +1,447 @@
+#!/usr/bin/env python2.7
+#
+# Vectorized similarity search over all patches for a device.
+#
+# AccessPatch.compare walks the definitions for every pair of patches.
+# SimilarityEngine instead encodes every patch once into a matrix of
+# numeric parameters, and a matrix of SELECT_TYPE choices, so finding the
+# patches nearest to a given patch is a single computation over the whole
+# library.
+#
+# Robert Bowdidge, December 2019.
+
+import bisect
+import multiprocessing
+import multiprocessing.pool
+import numpy
+
+import patch
+import patch_store
+
+# Penalty for SELECT_TYPE parameters with different values.  Matches the
+# (0, 64) score pair used by AccessPatch.compare.
+SELECT_MISMATCH_PENALTY = 64
+
+# Number of hash tables in an LSHIndex.  More tables find more of the true
+# nearest patches, and take longer to search.
+DEFAULT_LSH_TABLES = 16
+
+# Number of random projections combined in each LSH table.  More make
+# buckets smaller, so fewer patches are compared.
+LSH_BITS = 8
+
+# Number of possible SELECT_TYPE values: raw values 0-127, and -1 for a
+# missing parameter.
+SELECT_VALUES = 129
+
+# LSH slot width as a multiple of the typical distance to a patch's
+# SIMILAR_COUNT_HINT-th nearest patch.
+WIDTH_FACTOR = 4.0
+SIMILAR_COUNT_HINT = 10
+
+# Number of patches searched exactly to estimate the LSH slot width.
+WIDTH_SAMPLE_SIZE = 32
+
+
+class SimilarityEngine(object):
+    """Answers "which patches are most like this one?" for a single device.
+
+    Distances are the same euclidean distances returned by
+    AccessPatch.compare: numeric parameters contribute their difference,
+    SELECT_TYPE parameters contribute SELECT_MISMATCH_PENALTY if the
+    choices differ, and strings are ignored.
+    """
+
+    def __init__(self, definitions, patches, store=None):
+        """Builds the engine for patches.
+
+        If store is a PatchStore, its columns are used for the matrices
+        and its patches for the rows; patches is ignored.
+        """
+        # Labels of parameters compared by value.
+        self.numeric_labels = []
+        # Labels of parameters compared by equality.
+        self.select_labels = []
+        for block, label, _, _, type in definitions:
+            key = '%s_%s' % (block, label)
+            if type == patch.STRING_TYPE or type == patch.NONE_TYPE:
+                continue
+            if type == patch.SELECT_TYPE:
+                self.select_labels.append(key)
+            else:
+                self.numeric_labels.append(key)
+
+        # Map from label to its block, from the definitions.  Blocks don't
+        # depend on where parameters sit in the message.
+        self.label_blocks = patch.parse_plan(definitions, 0).blocks
+        # Names of blocks of parameters, such as osc1 or filter.
+        self.blocks = sorted(set(self.label_blocks[key] for key in
+                                 self.numeric_labels + self.select_labels))
+        # Columns x blocks matrices, with a 1 for each column's block.
+        self.numeric_blocks = self.block_matrix(self.numeric_labels)
+        self.select_blocks = self.block_matrix(self.select_labels)
+
+        if store is not None:
+            # Copies of the store's rows, which change separately.
+            self.patches = store.patches[:]
+            self.rows = store.rows.copy()
+            self.numeric = store.matrix(self.numeric_labels)
+            self.select = store.matrix(self.select_labels)
+            return
+
+        # Patches in the order of rows in the matrices.
+        self.patches = list(patches)
+        # Map from patch to its row.
+        self.rows = dict((p, i) for i, p in enumerate(self.patches))
+
+        self.numeric = numpy.array(
+            [self.encode_numeric(p) for p in self.patches],
+            dtype=numpy.int64).reshape(len(self.patches),
+                                       len(self.numeric_labels))
+        self.select = numpy.array(
+            [self.encode_select(p) for p in self.patches],
+            dtype=numpy.int64).reshape(len(self.patches),
+                                       len(self.select_labels))
+
+    def add(self, p):
+        """Adds a new patch to the end of the engine's matrices."""
+        self.rows[p] = len(self.patches)
+        self.patches.append(p)
+        self.numeric = numpy.vstack(
+            [self.numeric, numpy.array([self.encode_numeric(p)],
+                                       dtype=numpy.int64)])
+        self.select = numpy.vstack(
+            [self.select, numpy.array([self.encode_select(p)],
+                                      dtype=numpy.int64)])
+
+    def remove(self, patches):
+        """Removes patches from the engine's matrices."""
+        removed = [self.rows[p] for p in patches if p in self.rows]
+        if not removed:
+            return
+        self.numeric = numpy.delete(self.numeric, removed, axis=0)
+        self.select = numpy.delete(self.select, removed, axis=0)
+        self.patches, self.rows = patch_store.remove_rows(
+            self.patches, self.rows, patches)
+
+    def block_matrix(self, labels):
+        """Returns matrix mapping columns for labels to blocks."""
+        columns = dict((block, i) for i, block in enumerate(self.blocks))
+        matrix = numpy.zeros((len(labels), len(self.blocks)),
+                             dtype=numpy.int64)
+        for row, label in enumerate(labels):
+            matrix[row, columns[self.label_blocks[label]]] = 1
+        return matrix
+
+    def encode_numeric(self, p):
+        """Returns the numeric parameters of a patch as a list."""
+        return [p.settings.get(key, 0) for key in self.numeric_labels]
+
+    def encode_select(self, p):
+        """Returns the SELECT_TYPE parameters of a patch as a list."""
+        return [p.settings.get(key, -1) for key in self.select_labels]
+
+    def encoding(self, p):
+        """Returns (numeric, select) arrays encoding a patch."""
+        row = self.rows.get(p)
+        if row is not None:
+            return self.numeric[row], self.select[row]
+        return (numpy.array(self.encode_numeric(p), dtype=numpy.int64),
+                numpy.array(self.encode_select(p), dtype=numpy.int64))
+
+    def distances(self, p, rows=None):
+        """Returns array of distances from p to every patch in the engine.
+
+        If rows is an array of row numbers, only distances to those rows
+        are returned, in the same order.
+        """
+        numeric, select = self.encoding(p)
+        all_numeric = self.numeric
+        all_select = self.select
+        if rows is not None:
+            all_numeric = all_numeric[rows]
+            all_select = all_select[rows]
+        difference = all_numeric - numeric
+        squares = numpy.einsum('ij,ij->i', difference, difference)
+        mismatches = numpy.count_nonzero(all_select != select, axis=1)
+        squares += mismatches * SELECT_MISMATCH_PENALTY ** 2
+        return numpy.sqrt(squares)
+
+    def block_distances(self, p, others):
+        """Returns distances from p to each of others, block by block.
+
+        Returns a list with a dictionary for each patch in others, mapping
+        block name to distance.  Blocks are those of the definitions, and
+        squared differences are summed into blocks by a single matrix
+        product for all of others.  others must be in the engine.
+        """
+        if not others:
+            return []
+        rows = numpy.array([self.rows[o] for o in others], dtype=int)
+        numeric, select = self.encoding(p)
+        difference = self.numeric[rows] - numeric
+        squares = (difference * difference).dot(self.numeric_blocks)
+        mismatches = (self.select[rows] != select).astype(numpy.int64)
+        squares += mismatches.dot(self.select_blocks) * (
+            SELECT_MISMATCH_PENALTY ** 2)
+        return [dict(zip(self.blocks, distances.tolist()))
+                for distances in numpy.sqrt(squares)]
+
+    def most_similar(self, p, count):
+        """Returns list of (patch, score) for the count patches nearest p.
+
+        p itself is never included.  Patches with equal scores stay in
+        the order they were given to the engine.
+        """
+        scores = self.distances(p)
+        order = numpy.argsort(scores, kind='mergesort')
+        result = []
+        for i in order:
+            other = self.patches[i]
+            if other is p:
+                continue
+            result.append((other, float(scores[i])))
+            if len(result) == count:
+                break
+        return result
+
+
+class NeighbourTable(object):
+    """Precomputed list of most similar patches for every patch in an engine.
+
+    Lookups are a dictionary access.  Building the table runs one
+    SimilarityEngine query per patch, spread over a pool of threads;
+    numpy releases the interpreter lock for the heavy lifting.
+    """
+
+    def __init__(self, engine, count):
+        self.engine = engine
+        # Number of neighbours kept for each patch.
+        self.count = count
+        # Map from patch to list of (patch, score), nearest first.
+        self.neighbours = {}
+
+    def build(self, workers=None):
+        """Computes neighbours for every patch in the engine."""
+        if not workers:
+            workers = multiprocessing.cpu_count()
+        pool = multiprocessing.pool.ThreadPool(workers)
+        try:
+            results = pool.map(
+                lambda p: self.engine.most_similar(p, self.count),
+                self.engine.patches)
+        finally:
+            pool.close()
+            pool.join()
+        self.neighbours = dict(zip(self.engine.patches, results))
+
+    def similar(self, p):
+        """Returns list of (patch, score) for patches nearest p."""
+        return self.neighbours.get(p, [])
+
+    def add(self, p):
+        """Adds a patch to the engine and updates affected neighbour lists.
+
+        Only lists where the new patch ranks among the nearest change.
+        """
+        self.engine.add(p)
+        scores = self.engine.distances(p)
+        self.neighbours[p] = self.engine.most_similar(p, self.count)
+        for other, score in zip(self.engine.patches, scores):
+            if other is p:
+                continue
+            score = float(score)
+            similar = self.neighbours[other]
+            if len(similar) == self.count and score >= similar[-1][1]:
+                continue
+            # New patch is last in the engine, so it goes after any
+            # patches with an equal score.
+            position = bisect.bisect_right([s for _, s in similar], score)
+            similar.insert(position, (p, score))
+            del similar[self.count:]
+
+    def remove(self, patches):
+        """Removes patches from the engine and from neighbour lists.
+
+        Lists that held a removed patch are searched again.
+        """
+        removed = set(patches)
+        self.engine.remove(patches)
+        for p in removed:
+            self.neighbours.pop(p, None)
+        for p, similar in self.neighbours.items():
+            if any(other in removed for other, _ in similar):
+                self.neighbours[p] = self.engine.most_similar(p, self.count)
+
+
+class LSHIndex(object):
+    """Approximate nearest-neighbour search with random-projection LSH.
+
+    Exact searches compare a patch with every other patch.  Here each
+    patch is hashed into buckets of `tables` hash tables, and only
+    patches sharing a bucket with the one searched for are compared.
+
+    Patches are hashed as points in a space where euclidean distance is
+    the engine's distance: numeric parameters as they are, and each
+    SELECT_TYPE parameter as a one-hot vector scaled so different
+    choices are SELECT_MISMATCH_PENALTY apart.  Each table projects the
+    points onto `bits` random directions and cuts each projection into
+    slots `width` wide (p-stable LSH); nearby patches usually land in the
+    same slots.  The one-hot vectors are never built: their projections
+    are looked up per choice.
+
+    Searching more tables finds more of the true nearest patches but
+    takes longer; most_similar's probes argument trades one for the
+    other without rebuilding.
+    """
+
+    def __init__(self, engine, tables=DEFAULT_LSH_TABLES, bits=LSH_BITS,
+                 width=None, seed=0):
+        self.engine = engine
+        self.tables = tables
+        self.bits = bits
+        random = numpy.random.RandomState(seed)
+        hashes = tables * bits
+        self.numeric_directions = random.normal(
+            size=(len(engine.numeric_labels), hashes))
+        self.select_directions = random.normal(
+            size=(len(engine.select_labels), SELECT_VALUES, hashes)) * (
+                SELECT_MISMATCH_PENALTY / numpy.sqrt(2))
+        # Random multipliers combining the bits slot numbers of a table
+        # into a single bucket number.
+        self.mixers = random.randint(1, 2 ** 31, size=bits).astype(
+            numpy.int64)
+        if width is None:
+            width = self.estimate_width()
+        self.width = width
+        self.offsets = random.uniform(0, width, size=hashes)
+
+        # Bucket numbers for each row of the engine, rows x tables.
+        self.codes = self.hash(engine.numeric, engine.select)
+        # For each table, (sorted bucket numbers, rows in that order).
+        # Rebuilt on demand after patches are added or removed.
+        self.sorted_codes = None
+
+    def estimate_width(self):
+        """Returns a slot width suited to the patches in the engine.
+
+        Uses the typical distance to the SIMILAR_COUNT_HINT-th nearest
+        patch over a sample of patches, so the patches worth returning
+        usually share slots.
+        """
+        patches = self.engine.patches
+        if len(patches) < 2:
+            return 1.0
+        step = max(1, len(patches) // WIDTH_SAMPLE_SIZE)
+        nearest = []
+        for p in patches[::step][:WIDTH_SAMPLE_SIZE]:
+            scores = numpy.sort(self.engine.distances(p))
+            nearest.append(scores[min(SIMILAR_COUNT_HINT, len(scores) - 1)])
+        return max(1.0, WIDTH_FACTOR * float(numpy.median(nearest)))
+
+    def project(self, numeric, select):
+        """Returns rows x hashes array of projections of encoded patches."""
+        projections = numeric.dot(self.numeric_directions)
+        choices = numpy.clip(select + 1, 0, SELECT_VALUES - 1)
+        for column in range(choices.shape[1]):
+            projections += self.select_directions[column][choices[:, column]]
+        return projections
+
+    def hash(self, numeric, select):
+        """Returns rows x tables array of bucket numbers."""
+        if not len(numeric):
+            return numpy.zeros((0, self.tables), dtype=numpy.int64)
+        slots = numpy.floor((self.project(numeric, select) + self.offsets) /
+                            self.width).astype(numpy.int64)
+        slots = slots.reshape(len(numeric), self.tables, self.bits)
+        return (slots * self.mixers).sum(axis=2)
+
+    def buckets(self):
+        """Returns list of (sorted bucket numbers, rows) for each table."""
+        if self.sorted_codes is None:
+            self.sorted_codes = []
+            for table in range(self.tables):
+                order = numpy.argsort(self.codes[:, table], kind='mergesort')
+                self.sorted_codes.append((self.codes[order, table], order))
+        return self.sorted_codes
+
+    def candidates(self, p, probes=None):
+        """Returns sorted array of rows sharing a bucket with p."""
+        row = self.engine.rows.get(p)
+        if row is not None:
+            codes = self.codes[row]
+        else:
+            numeric, select = self.engine.encoding(p)
+            codes = self.hash(numeric[numpy.newaxis],
+                              select[numpy.newaxis])[0]
+        found = [[]]
+        for table, (sorted_codes, order) in enumerate(
+                self.buckets()[:probes or self.tables]):
+            start = numpy.searchsorted(sorted_codes, codes[table], 'left')
+            end = numpy.searchsorted(sorted_codes, codes[table], 'right')
+            found.append(order[start:end])
+        return numpy.unique(numpy.concatenate(found).astype(int))
+
+    def most_similar(self, p, count, probes=None):
+        """Returns list of (patch, score) for about the count nearest p.
+
+        probes is the number of tables searched, all of them by default.
+        Scores are exact; some of the true nearest patches may be missed.
+        Falls back to an exact search if too few patches share buckets
+        with p.
+        """
+        rows = self.candidates(p, probes)
+        row = self.engine.rows.get(p)
+        if row is not None:
+            rows = rows[rows != row]
+        if len(rows) < count:
+            return self.engine.most_similar(p, count)
+        scores = self.engine.distances(p, rows)
+        order = numpy.argsort(scores, kind='mergesort')[:count]
+        return [(self.engine.patches[rows[i]], float(scores[i]))
+                for i in order]
+
+    def add(self, p):
+        """Hashes a patch just added to the engine."""
+        numeric, select = self.engine.encoding(p)
+        self.codes = numpy.vstack(
+            [self.codes, self.hash(numeric[numpy.newaxis],
+                                   select[numpy.newaxis])])
+        self.sorted_codes = None
+
+    def remove(self, patches):
+        """Forgets patches about to be removed from the engine."""
+        removed = [self.engine.rows[p] for p in patches
+                   if p in self.engine.rows]
+        self.codes = numpy.delete(self.codes, removed, axis=0)
+        self.sorted_codes = None
+
+
+def build_engines(stores):
+    """Returns dictionary mapping device name to a SimilarityEngine.
+
+    stores is a dictionary mapping device name to PatchStore.
+    """
+    return dict((device, SimilarityEngine(store.definitions, None, store))
+                for device, store in stores.items())
+
+
+def build_lsh_indexes(engines, minimum_size, tables=DEFAULT_LSH_TABLES):
+    """Returns dictionary mapping device name to an LSHIndex.
+
+    Only engines with more than minimum_size patches get an index; exact
+    search is fast enough for the others.
+    """
+    return dict((device, LSHIndex(engine, tables))
+                for device, engine in engines.items()
+                if len(engine.patches) > minimum_size)
+
+
+def build_neighbour_tables(engines, count, workers=None):
+    """Returns dictionary mapping device name to a built NeighbourTable."""
+    tables = {}
+    for device, engine in engines.items():
+        table = NeighbourTable(engine, count)
+        table.build(workers)
+        tables[device] = table
+    return tables
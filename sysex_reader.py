@@ -0,0 +1,163 @@
+#!/usr/bin/env python2.7
+#
+# Fast reader for files of raw sysex messages.
+#
+# mido.read_syx_file builds a message object for every sysex message, and
+# callers then turn each back into bytes with bin().  Patch files are
+# nothing but a run of F0 ... F7 messages, so we can split them ourselves
+# straight from a memory-mapped copy of the file.  Anything that isn't a
+# clean run of messages (hex text files, stray bytes) is left to mido.
+#
+# Standard MIDI files holding banks are walked chunk by chunk and event by
+# event straight from the file, keeping nothing but the sysex messages
+# asked for, rather than building mido objects for every track.
+#
+# Robert Bowdidge, December 2019.
+
+import mmap
+import mido
+import os
+import struct
+
+SYSEX_START = chr(0xf0)
+SYSEX_END = chr(0xf7)
+
+# All bytes allowed inside a sysex message between F0 and F7.
+DATA_BYTES = ''.join(chr(i) for i in range(0x80))
+
+# Chunk types in standard MIDI files.
+MIDI_HEADER_CHUNK = 'MThd'
+MIDI_TRACK_CHUNK = 'MTrk'
+
+# Status bytes of track events that aren't channel messages.
+META_EVENT = 0xff
+SYSEX_EVENT = 0xf0
+ESCAPE_EVENT = 0xf7
+
+# Number of data bytes following each kind of channel message status,
+# by the status's high nibble.  Everything else has two.
+CHANNEL_DATA_LENGTHS = {0xc0: 1, 0xd0: 1}
+
+
+def split_sysex(data):
+    """Returns list of sysex messages in a buffer of raw bytes.
+
+    data can be a string or an mmap.  Each message is returned as a
+    bytearray including the F0 and F7 bytes.  Returns None if data
+    isn't entirely made up of well-formed sysex messages.
+    """
+    messages = []
+    position = 0
+    while position < len(data):
+        if data[position] != SYSEX_START:
+            return None
+        end = data.find(SYSEX_END, position)
+        if end < 0:
+            return None
+        # buffer() lets us copy each message out of data exactly once.
+        message = bytearray(buffer(data, position, end + 1 - position))
+        if message.translate(None, DATA_BYTES) != bytearray([0xf0, 0xf7]):
+            return None
+        messages.append(message)
+        position = end + 1
+    return messages
+
+
+def read_syx_file(filepath):
+    """Returns list of sysex messages in a .syx file as bytearrays.
+
+    Falls back to mido for files that aren't plain binary sysex.
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            messages = split_sysex(data)
+        finally:
+            data.close()
+    if messages is not None:
+        return messages
+    return [message.bin() for message in mido.read_syx_file(filepath)]
+
+
+def read_variable_length(f):
+    """Returns a variable-length quantity read from a MIDI file."""
+    value = 0
+    while True:
+        byte = f.read(1)
+        if not byte:
+            raise EOFError('MIDI file ends inside a number')
+        byte = ord(byte)
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value
+
+
+def read_track_sysex(f, end):
+    """Yields the sysex messages in a track ending at offset end of f.
+
+    Messages split into an F0 packet and F7 continuation packets are
+    joined.  Other events are skipped without being read into memory.
+    """
+    running_status = None
+    # Sysex message still waiting for its continuation packets.
+    pending = None
+    while f.tell() < end:
+        read_variable_length(f)
+        status = f.read(1)
+        if not status:
+            raise EOFError('MIDI file ends inside a track')
+        status = ord(status)
+        if status == META_EVENT:
+            f.read(1)
+            f.seek(read_variable_length(f), os.SEEK_CUR)
+        elif status == SYSEX_EVENT or status == ESCAPE_EVENT:
+            data = f.read(read_variable_length(f))
+            if status == SYSEX_EVENT:
+                pending = bytearray(SYSEX_START)
+            elif pending is None:
+                # An escape holding arbitrary bytes, not part of sysex.
+                continue
+            pending += data
+            if pending.endswith(SYSEX_END):
+                yield pending
+                pending = None
+        else:
+            already_read = 0
+            if status >= 0x80:
+                running_status = status
+            elif running_status is None:
+                raise ValueError('MIDI data byte without a status')
+            else:
+                # Running status: this byte was the first data byte.
+                already_read = 1
+            length = CHANNEL_DATA_LENGTHS.get(running_status & 0xf0, 2)
+            f.seek(length - already_read, os.SEEK_CUR)
+
+
+def read_midi_sysex(filepath, length=None):
+    """Yields sysex messages in a standard MIDI file as bytearrays.
+
+    Tracks are read in order, in a single pass over the file.  Each
+    message includes its F0 and F7 bytes.  If length is given, only
+    messages of that many bytes are returned.  Raises ValueError for
+    files that aren't MIDI files.
+    """
+    with open(filepath, 'rb') as f:
+        header = f.read(8)
+        if len(header) < 8 or not header.startswith(MIDI_HEADER_CHUNK):
+            raise ValueError('%s is not a MIDI file' % filepath)
+        _, size = struct.unpack('>4sI', header)
+        f.seek(size, os.SEEK_CUR)
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            chunk_type, size = struct.unpack('>4sI', header)
+            end = f.tell() + size
+            if chunk_type == MIDI_TRACK_CHUNK:
+                for message in read_track_sysex(f, end):
+                    if length is None or len(message) == length:
+                        yield message
+            f.seek(end)
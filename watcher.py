@@ -0,0 +1,166 @@
+#!/usr/bin/env python2.7
+#
+# Watching patch directories for added, changed and removed files.
+#
+# A Watcher compares snapshots of each patch file's modification time and
+# size.  On Linux, inotify tells us when a directory changes, so we only
+# rescan then; elsewhere we rescan every few seconds.
+#
+# Robert Bowdidge, December 2019.
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import time
+
+# Seconds between rescans when polling.
+POLL_INTERVAL = 2.0
+
+# Seconds to wait after a directory change before rescanning, so a file
+# still being copied is picked up once it is complete.
+SETTLE_TIME = 0.5
+
+# Seconds between rescans even when inotify reports nothing, in case
+# events were missed.
+INOTIFY_RESCAN_INTERVAL = 60.0
+
+# inotify event flags, from <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+WATCH_EVENTS = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot(files):
+    """Returns dictionary mapping each file to (mtime, size)."""
+    result = {}
+    for filepath in files:
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            # Removed since it was found.
+            continue
+        result[filepath] = (stat.st_mtime, stat.st_size)
+    return result
+
+
+class Watcher(object):
+    """Notices patch files added, changed or removed, by polling.
+
+    find_files is a function returning the list of patch files currently
+    in the watched directories.
+    """
+
+    def __init__(self, directories, find_files, interval=POLL_INTERVAL):
+        self.directories = directories
+        self.find_files = find_files
+        self.interval = interval
+        # Map from file to (mtime, size) at the last scan.
+        self.files = snapshot(find_files())
+
+    def changes(self):
+        """Returns (added, changed, removed) lists of files since last call."""
+        files = snapshot(self.find_files())
+        added = sorted(f for f in files if f not in self.files)
+        changed = sorted(f for f in files
+                         if f in self.files and files[f] != self.files[f])
+        removed = sorted(f for f in self.files if f not in files)
+        self.files = files
+        return added, changed, removed
+
+    def wait(self):
+        """Returns when the directories may have changed."""
+        time.sleep(self.interval)
+
+    def watch(self, callback):
+        """Calls callback(added, changed, removed) for changes, forever."""
+        while True:
+            self.wait()
+            added, changed, removed = self.changes()
+            if added or changed or removed:
+                callback(added, changed, removed)
+
+
+class InotifyWatcher(Watcher):
+    """Watcher that sleeps until inotify reports a directory change.
+
+    inotify watches single directories, so every directory in the watched
+    trees is added.
+    """
+
+    def __init__(self, directories, find_files, libc):
+        Watcher.__init__(self, directories, find_files,
+                         INOTIFY_RESCAN_INTERVAL)
+        self.libc = libc
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.add_watches()
+
+    def add_watches(self):
+        """Watches every directory, including subdirectories added since.
+
+        Watching a directory twice is harmless.
+        """
+        for directory in self.directories:
+            for path, _, _ in os.walk(directory, followlinks=True):
+                self.libc.inotify_add_watch(self.fd, path, WATCH_EVENTS)
+
+    def drain(self, timeout):
+        """Returns True if events arrived within timeout, discarding them."""
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        if not ready:
+            return False
+        os.read(self.fd, 65536)
+        return True
+
+    def wait(self):
+        if not self.drain(self.interval):
+            return
+        # Let a burst of changes finish before rescanning.
+        while self.drain(SETTLE_TIME):
+            pass
+        self.add_watches()
+
+
+def inotify_libc():
+    """Returns the C library if it supports inotify, or None."""
+    name = ctypes.util.find_library('c')
+    if not name:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init'):
+        return None
+    return libc
+
+
+def make_watcher(directories, find_files, interval=POLL_INTERVAL):
+    """Returns the best Watcher for this system.
+
+    interval is only used when polling.
+    """
+    libc = inotify_libc()
+    if libc:
+        try:
+            return InotifyWatcher(directories, find_files, libc)
+        except OSError as e:
+            logger.warning('Unable to use inotify, polling instead: %s', e)
+    return Watcher(directories, find_files, interval)